@@ -8,8 +8,14 @@ import datetime
 from zeustools import mce_data
 import struct
 import zeustools as zt
-from zeustools import numba_reduction
+import tailreader
+import tsfile
+import filewatch
+import catalog
+import chopstream
 import socket
+import threading
+from queue import Queue, Full, Empty
 
 APECS_FRAME_STRUCTURE = struct.Struct('<8s I 8s 28s I I I I I I f') 
 # I don't really know about this but it's little endian encoded 
@@ -21,142 +27,401 @@ APECS_FRAME_STRUCTURE = struct.Struct('<8s I 8s 28s I I I I I I f')
 # then 4 integers ==1
 # and then the data as a float.
 
+APECS_HEADER_FIELDS = [
+    ('encoding', 'S8'),
+    ('length', '<u4'),
+    ('backend', 'S8'),
+    ('timestamp', 'S28'),
+    ('itime', '<u4'),
+    ('phase', '<u4'),
+    ('nsections', '<u4'),
+    ('blocking', '<u4')]
+APECS_SECTION_DTYPE = np.dtype([
+    ('section', '<u4'),
+    ('nchannels', '<u4'),
+    ('data', '<f4')])
+# The 64 byte header is followed by nsections of these (we always
+# send one channel per section)
+
+
+def apecs_frame_dtype(n_sections=1):
+    """ numpy dtype of one APECS backend frame with n_sections
+    sections, so a whole batch of frames can be built at once and sent
+    with .tobytes() """
+    return np.dtype(APECS_HEADER_FIELDS +
+                    [('sections', APECS_SECTION_DTYPE, (n_sections,))])
+
+
+APECS_FRAME_DTYPE = apecs_frame_dtype(1)
+assert APECS_FRAME_DTYPE.itemsize == APECS_FRAME_STRUCTURE.size
+
+SECTION_MODE = "mean"
+# What keep_reading_file sends to APECS:
+# "mean": one section, the mean of all the px.cfg pixels
+# "pixel": one section per px.cfg pixel, in px.cfg order
+# "array": one section per array (200/350/400/450) in px.cfg, holding
+#     the mean of that array's pixels
+# APECS has to be told to expect the same number of sections
+# (cmdUsedSections).
+
+SUBSCRIBER_BUFFER = 1000
+# batches of frames a client may fall behind by before we drop it
+SUBSCRIBER_BUFFER_BYTES = 16 * 1024 * 1024
+# bytes of frames a client may fall behind by before we drop it
+SEND_TIMEOUT = 10.0
+# s a client may take to accept a batch before we drop it
+
+WRITER_IDLE = 30.0
+# s without new frames after which a subscan the catalog doesn't know
+# is over (or never will be) is treated as finished
+
+READER_MODE = "read"
+# How keep_reading_file reads the live data file:
+# "read": SmallMCEFile.Read of the new frames
+# "memmap": the whole array through np.memmap
+# "pixels": only the px.cfg pixels through np.memmap
+# See tailreader.SubscanTail.
+
+def is_new_file(file, conn_timestamp_gps):
+    """ True if the .ts file started after we were connected to and its
+    data file can be opened """
+    firsttime = tsfile.read_first_timestamp(file)
+    if firsttime is None or firsttime <= conn_timestamp_gps-1:
+        return False
+    try:
+        mce_data.SmallMCEFile(file.replace(".ts", ""))
+    except:
+        return False
+    return True
+
+
+def writer_finished(data_file):
+    """ True once the acquisition code has marked data_file as done,
+    whether or not it got all its frames """
+    row = catalog.get_catalog().get(os.path.basename(data_file))
+    return row is not None and row["state"] in (
+        catalog.COMPLETE, catalog.CRASHED, catalog.ABORTED)
+
+
 def get_recent_file():
     connection_time = datetime.datetime.utcnow()
     conn_time_gps = leapseconds.utc_to_gps(connection_time)
     conn_timestamp_gps = conn_time_gps.replace(tzinfo=datetime.timezone.utc).timestamp()
     path = "/data/cryo/current_data/" 
-    old_file = True
+    watcher = filewatch.get_watcher(path)
+    scans = catalog.get_catalog()
     # find the correct data file based on timestamps
-    while old_file:
-        files = glob(path + "*.ts")
-        files = sorted(files)[::-1]
-        for file in files:
-            modified_time = os.path.getmtime(file)
-            if modified_time > time.time() - 9:
-                print(f"{file} was modified recently...")
-                ts = np.genfromtxt(file, invalid_raise=False)
-                try:
-                    firsttime = ts[0, 1] 
-
-                    if firsttime > conn_timestamp_gps-1:
-                        try:
-                            mce_data.SmallMCEFile(file.replace(".ts", ""))
-                            old_file = False
-                        except:
-                            continue
+    while True:
+        current = scans.current(states=(catalog.ACQUIRING, catalog.ARMED))
+        if current is not None:
+            # the catalog knows what is being written, no need to look
+            # through the whole directory
+            file = path + current + ".ts"
+            if os.path.exists(file) and is_new_file(file, conn_timestamp_gps):
+                return file
+        else:
+            # nothing going on according to the catalog, but the file
+            # may have been started by something that doesn't use it
+            # (a manual mce_run)
+            files = glob(path + "*.ts")
+            files = sorted(files)[::-1]
+            for file in files:
+                modified_time = os.path.getmtime(file)
+                if modified_time > time.time() - 9:
+                    print(f"{file} was modified recently...")
+                    if is_new_file(file, conn_timestamp_gps):
                         return file
-                except IndexError:
-                    pass
         print("no new files...")
-        time.sleep(1)
-
-
-def read_as_much_as_possible(data_file):
-    ts = np.genfromtxt(data_file+'.ts', invalid_raise=False)[:, 1]
-    frames_ready = len(ts)
-    mcedata = mce_data.SmallMCEFile(data_file)
-    data = mcedata.Read(row_col=True)
-    cube = data.data
-    chop = data.chop
-    if cube.shape[2] < frames_ready:
-        frames_ready = cube.shape[2]
-        ts = ts[0:frames_ready]
-    elif cube.shape[2] > frames_ready:
-        cube = cube[:, :, 0:frames_ready]
-        chop = chop[0:frames_ready]
-    #print(cube.shape)
-    #print(frames_ready)
-    d = numba_reduction.offset_data_reduction(chop, cube)
-    return d, chop, ts, frames_ready
-
-
-def get_struct(ts, itime, chop, data, i):
-    ts_datetime = datetime.datetime.utcfromtimestamp(ts[i])
-    timestamp = ts_datetime.isoformat()[:24]+"GPS "
-    itimeus = int(itime[i]*1e6)
-    pfstring = f"{timestamp} {itimeus} {int(chop[i])} {data}"
-
-    print(pfstring)
-    encoded_frame=APECS_FRAME_STRUCTURE.pack(
-        'EEEIF   '.encode(), 
-        76, 
-        'ZEUS2BE '.encode(),
-        timestamp.encode(),
-        itimeus,
-        int(chop[i]),
-        1, 1, 1, 1,
-        data)
-    return encoded_frame, pfstring
-
-
-def keep_reading_file(data_file, mce_px, callback):
-    mcedata = mce_data.SmallMCEFile(data_file)
-    nframes = int(mcedata.runfile.data["FRAMEACQ"]["DATA_FRAMECOUNT"].strip())
-
-    frames_sent = 0
-    lines_sent = 0
+        watcher.wait(timeout=1)
+
+
+def format_timestamps(ts):
+    """ Turns an array of GPS unix timestamps into the 28 byte
+    TIMESTAMPISOGPS field, e.g. b"2023-06-01T01:02:03.4567GPS " """
+    return leapseconds.format_iso(ts, 4, b"GPS ")
+
+
+def encode_frames(ts, itime, chop, data):
+    """ Builds APECS backend frames for a batch of lines at once.
+
+    :param ts: GPS unix timestamp of each line
+    :param itime: integration time of each line in seconds
+    :param chop: phase of each line (1 or 2)
+    :param data: value to send for each line, either one per line or
+        lines x sections
+    :return: (frames, pfstrings) where frames is an array of
+        apecs_frame_dtype(sections) and pfstrings has one line of text
+        per frame for the .pf file.
+    """
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    n_sections = data.shape[1]
+    dtype = apecs_frame_dtype(n_sections)
+    frames = np.zeros(len(ts), dtype=dtype)
+    frames['encoding'] = b'EEEIF   '
+    frames['length'] = dtype.itemsize
+    frames['backend'] = b'ZEUS2BE '
+    frames['timestamp'] = format_timestamps(ts)
+    frames['itime'] = np.asarray(itime) * 1e6
+    frames['phase'] = chop
+    frames['nsections'] = n_sections
+    frames['blocking'] = 1
+    frames['sections']['section'] = np.arange(1, n_sections + 1)
+    frames['sections']['nchannels'] = 1
+    frames['sections']['data'] = data
+    pfstrings = [f"{t.decode()} {i} {c} {' '.join(map(str, x))}"
+                 for t, i, c, x in
+                 zip(frames['timestamp'], frames['itime'], frames['phase'], data)]
+    return frames, pfstrings
+
+
+def section_weights(sections, n_px):
+    """ sections x pixels matrix that averages the pixels of each
+    section when multiplied with a pixels x lines array """
+    weights = np.zeros((len(sections), n_px))
+    for i, section in enumerate(sections):
+        weights[i, section] = 1 / len(section)
+    return weights
+
+
+def keep_reading_file(data_file, mce_px, callback, sections=None):
+    """ Reduce the subscan in data_file as it is written and pass the
+    encoded APECS frames to callback. Stops once all frames are in, the
+    catalog says the subscan is over (aborted or crashed subscans end
+    early), or nothing was written for WRITER_IDLE seconds. A chop
+    cycle left incomplete at the end isn't sent.
+
+    :param mce_px: list of MCE (row, col) to send
+    :param sections: list of lists of indices into mce_px, one list per
+        APECS section. Each section gets the mean of its pixels. By
+        default all pixels are averaged into a single section.
+    """
+    if sections is None:
+        sections = [list(range(len(mce_px)))]
+    weights = section_weights(sections, len(mce_px))
+    if READER_MODE == "pixels":
+        tail = tailreader.SubscanTail(data_file, pixels=mce_px)
+        # the tail's cube only has our pixels, one per row
+        rows = np.arange(len(mce_px))
+        cols = np.zeros(len(mce_px), dtype=int)
+    else:
+        tail = tailreader.SubscanTail(data_file,
+                                      use_memmap=READER_MODE == "memmap")
+        rows, cols = zip(*mce_px)
+    phases = chopstream.PhaseAccumulator(tail)
+    nframes = tail.n_frames
+    watcher = filewatch.get_watcher()
+    last_frames = 0
+    last_growth = time.monotonic()
+
     with open(data_file+".pf", 'w') as pf:
-        while frames_sent < nframes-1:
-            print(frames_sent)
-            d, chop, ts, frames_ready = read_as_much_as_possible(data_file)
-            #print(d[1,1])
-            chunked_ts, chunked_chop = numba_reduction.chunk_data_1d(chop, ts)
-            ts_for_apex = numba_reduction.reduce_chunks_1d(chunked_ts)
-            chop_for_apex = np.array(chunked_chop) + 1
-            itime_for_apex = [c[-1] - c[0] for c in chunked_ts]
-            # print(len(chunked_ts[-1]),len(chunked_ts[-2]))
-            lines_to_send = d.shape[2]*2
-            if len(chunked_ts[-1]) < len(chunked_ts[-2]):
-                lines_to_send -= 1 
-            for i in range(lines_sent, lines_to_send):
-                if chop_for_apex[i] == 1:
-                    data_for_apex = 1
-                else:
-                    data_for_apex = []
-                    for px in mce_px:
-                        data_for_apex.append(d[px][i//2])
-                    data_for_apex = np.mean(data_for_apex)
-
-                encoded_frame, pfstring = get_struct(
-                    ts_for_apex,
-                    itime_for_apex,
-                    chop_for_apex,
-                    data_for_apex,
-                    i
+        while not phases.finished:
+            token = watcher.token()
+            # before polling, so the poll sees everything written
+            # before the subscan was marked done
+            done = writer_finished(data_file)
+            frames_ready = tail.poll()
+            print(frames_ready)
+            phases.update(frames_ready)
+            if frames_ready > last_frames:
+                last_frames = frames_ready
+                last_growth = time.monotonic()
+            elif time.monotonic() - last_growth > WRITER_IDLE:
+                print(f"nothing new in {data_file} for {WRITER_IDLE} s")
+                done = True
+            if frames_ready >= nframes-1 or done:
+                phases.finish()
+            lines = phases.emit()
+            if lines is not None:
+                ts, itime, chop, reduced = lines
+                section_data = (weights @ reduced[rows, cols]).T
+                data_for_apex = np.where(chop[:, np.newaxis] == 1, 1,
+                                         section_data)
+                frames, pfstrings = encode_frames(
+                    ts,
+                    itime,
+                    chop,
+                    data_for_apex
                 )
-                pf.write(pfstring+'\n')
-                callback(encoded_frame)
-                lines_sent += 1
-            frames_sent = frames_ready   
-            time.sleep(0.5)
+                pftext = '\n'.join(pfstrings) + '\n'
+                print(pftext, end='')
+                pf.write(pftext)
+                callback(frames.tobytes())
+            if not phases.finished:
+                # wake up as soon as mce_run or zframetimes write more
+                watcher.wait([data_file, data_file+".ts"],
+                             since=token, timeout=0.5)
+
+
+def read_pixel_config(section_mode=None):
+    """ Returns (mce_px, sections): the MCE (row, col) of every pixel
+    listed in px.cfg, and how to group them into APECS sections
+    according to section_mode (see SECTION_MODE) """
+    if section_mode is None:
+        section_mode = SECTION_MODE
+    am = zt.ArrayMapper()
+    pxs = np.genfromtxt("px.cfg", dtype=int)
+    if len(pxs.shape) == 1:
+        pxs = [pxs]
+    print(pxs)
+    mce_px = []
+    for px in pxs:
+        mce_px.append(am.phys_to_mce(px[0], px[1], px[2]))
+    if section_mode == "pixel":
+        sections = [[i] for i in range(len(pxs))]
+    elif section_mode == "array":
+        arrays = [px[2] for px in pxs]
+        sections = [[i for i, a in enumerate(arrays) if a == array]
+                    for array in sorted(set(arrays))]
+    else:
+        sections = [list(range(len(pxs)))]
+    return mce_px, sections
+
+
+class Subscriber:
+    def __init__(self):
+        """ One connection's view of a SubscanPublisher. q is this
+        connection's private send buffer, limited to SUBSCRIBER_BUFFER
+        batches and SUBSCRIBER_BUFFER_BYTES bytes. """
+        self.q = Queue(maxsize=SUBSCRIBER_BUFFER)
+        self.lock = threading.Lock()
+        self.queued_bytes = 0
+        self.dropped = False
+
+    def put(self, item):
+        """ Queue item without blocking. Raises Full if that would put
+        the connection too far behind. """
+        size = 0 if item is None else len(item)
+        with self.lock:
+            if self.queued_bytes + size > SUBSCRIBER_BUFFER_BYTES:
+                raise Full
+            self.q.put_nowait(item)
+            self.queued_bytes += size
+
+    def get(self, timeout=None):
+        item = self.q.get(timeout=timeout)
+        if item is not None:
+            with self.lock:
+                self.queued_bytes -= len(item)
+        return item
+
+
+class SubscanPublisher(threading.Thread):
+    def __init__(self, data_file, mce_px, sections=None):
+        """ Reduces one subscan once and hands the encoded frames to
+        every subscribed connection. Each subscriber has its own bounded
+        queue: a client that stops reading only fills its own queue and
+        is then dropped. It never holds up the reduction or the other
+        clients (i.e. the FitsWriter).
+        Use get_publisher() rather than creating these directly.
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.data_file = data_file
+        self.mce_px = mce_px
+        self.sections = sections
+        self.lock = threading.Lock()
+        self.backlog = []  # everything published so far, for late joiners
+        self.subscribers = []
+        self.finished = False
+
+    def subscribe(self):
+        sub = Subscriber()
+        with self.lock:
+            if self.backlog:
+                self._offer(sub, b"".join(self.backlog))
+            if self.finished:
+                self._offer(sub, None)
+            elif not sub.dropped:
+                self.subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+
+    def publish(self, frames):
+        """ Used as the keep_reading_file callback. Never blocks. """
+        with self.lock:
+            self.backlog.append(frames)
+            for sub in list(self.subscribers):
+                self._offer(sub, frames)
+
+    def _offer(self, sub, item):
+        try:
+            sub.put(item)
+        except Full:
+            print("client has fallen too far behind, dropping it")
+            sub.dropped = True
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+
+    def run(self):
+        try:
+            keep_reading_file(self.data_file, self.mce_px, self.publish,
+                              self.sections)
+        finally:
+            with self.lock:
+                self.finished = True
+                for sub in list(self.subscribers):
+                    self._offer(sub, None)
+            with publishers_lock:
+                publishers.pop(self.data_file, None)
+
+
+publishers = {}  # data file -> SubscanPublisher
+publishers_lock = threading.Lock()
+
+
+def get_publisher(data_file):
+    """ Returns the SubscanPublisher for data_file, starting one if
+    nobody is reading that subscan yet """
+    with publishers_lock:
+        publisher = publishers.get(data_file)
+        if publisher is None:
+            mce_px, sections = read_pixel_config()
+            publisher = SubscanPublisher(data_file, mce_px, sections)
+            publishers[data_file] = publisher
+            publisher.start()
+    return publisher
 
 
 class ApecsRequestHandler(socketserver.BaseRequestHandler):
     def handle(self):
         try:
             print("Apex data connected!")
-            am = zt.ArrayMapper()
             correct_ts_file = get_recent_file()
             data_file = correct_ts_file.replace(".ts", "")
+            publisher = get_publisher(data_file)
+            sub = publisher.subscribe()
+            # a client that stops reading gets dropped instead of
+            # holding this thread forever
+            self.request.settimeout(SEND_TIMEOUT)
+            try:
+                while not sub.dropped:
+                    try:
+                        frames = sub.get(timeout=SEND_TIMEOUT)
+                    except Empty:
+                        continue  # nothing new yet, see if we were dropped
+                    if frames is None:
+                        break
+                    self.request.sendall(frames)
+            finally:
+                publisher.unsubscribe(sub)
 
-            pxs = np.genfromtxt("px.cfg", dtype=int)
-            if len(pxs.shape) == 1:
-                pxs = [pxs]
-            print(pxs)
-            mce_px = []
-            for px in pxs:
-                mce_px.append(am.phys_to_mce(px[0], px[1], px[2]))
-            keep_reading_file(data_file, mce_px, self.sender)
-        
         except BrokenPipeError:
             print("Disconnected")
+        except socket.timeout:
+            print(f"client took over {SEND_TIMEOUT} s to take its data, "
+                  f"dropping it")
 
-    def sender(self, frame):
-        self.request.sendall(frame)
 
+class NonBlockingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # each connection gets its own thread, so a second client doesn't
+    # have to wait for the first one to hang up.
+    daemon_threads = True
 
-class NonBlockingTCPServer(socketserver.TCPServer):
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(self.server_address)
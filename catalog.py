@@ -0,0 +1,194 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from glob import glob
+import tsfile
+
+DATA_PATH = "/data/cryo/current_data/"
+CATALOG_FILE = DATA_PATH + "zeta_catalog.sqlite"
+SIDECAR_EXTENSIONS = [".run", ".ts", ".tsb", ".chop", ".hk", ".pf"]
+
+ARMED = "armed"  # reserved, helper processes waiting for the start
+ACQUIRING = "acquiring"
+COMPLETE = "complete"
+CRASHED = "crashed"
+ABORTED = "aborted"
+# s; an ACQUIRING row older than this was left behind by a crash
+ACQUIRING_TIMEOUT = 600
+
+
+class ScanCatalog:
+    def __init__(self, filename=CATALOG_FILE, path=DATA_PATH):
+        """ Persistent index of the subscans in the data directory, so
+        that "what number comes next" and "which file is being written
+        right now" don't need a glob and a stat of every file.
+
+        The acquisition code reserves a row when it picks a filename and
+        marks it complete (or crashed) when it is done with it. Prefixes
+        the catalog has never seen are imported from the directory once,
+        and reserve() still skips numbers whose files turn up on disk.
+
+        :param filename: sqlite database to keep the catalog in
+        :param path: the data directory the catalog describes
+        """
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(filename, timeout=5,
+                                  check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS subscans (
+                name TEXT PRIMARY KEY,
+                prefix TEXT,
+                seq INTEGER,
+                scan_num INTEGER,
+                start_gps REAL,
+                n_frames INTEGER,
+                state TEXT,
+                sidecars TEXT,
+                created REAL)""")
+            self.db.execute("""CREATE INDEX IF NOT EXISTS prefix_seq
+                ON subscans (prefix, seq)""")
+            self.db.execute("""CREATE INDEX IF NOT EXISTS state_created
+                ON subscans (state, created)""")
+
+    def _import_prefix(self, template):
+        """ Record files matching template that were written before the
+        catalog knew about them. Only the highest number matters. """
+        prefix = template.format(num="")
+        files = glob(self.path + template.format(num="????"))
+        if len(files) == 0:
+            seq = -1
+            print("no files found, starting at 0")
+        else:
+            lastfile = os.path.basename(sorted(files)[-1])
+            seq = int(lastfile.replace(prefix, ""))
+        # a placeholder row remembers that this prefix has been imported
+        self.db.execute(
+            "INSERT OR IGNORE INTO subscans VALUES (?,?,?,?,?,?,?,?,?)",
+            (prefix + "{imported}", prefix, seq, _scan_num(prefix),
+             None, None, COMPLETE, "", time.time()))
+
+    def next_sequence(self, template):
+        """ Next free {num} for a filename template like
+        "apecs_12345_{num}" """
+        prefix = template.format(num="")
+        with self.lock:
+            row = self.db.execute(
+                "SELECT MAX(seq) FROM subscans WHERE prefix=?",
+                (prefix,)).fetchone()
+            if row[0] is None:
+                with self.db:
+                    self._import_prefix(template)
+                return self.next_sequence(template)
+            return row[0] + 1
+
+    def reserve(self, template, n_frames=None, state=ACQUIRING):
+        """ Pick the filename for a new subscan and record it as being
+        acquired.
+
+        :param template: filename, optionally with "{num}" in it to be
+            replaced by the next sequence number (4 digits)
+        :param state: ARMED if the acquisition starts later, see start()
+        :return: the filename to acquire into
+        """
+        with self.lock:
+            if "{num}" in template:
+                seq = self.next_sequence(template)
+                prefix = template.format(num="")
+                name = template.format(num="{:04d}".format(seq))
+                # written by something that doesn't use the catalog
+                while self._on_disk(name):
+                    print(f"{name} already exists, skipping it")
+                    seq += 1
+                    name = template.format(num="{:04d}".format(seq))
+            else:
+                seq = None
+                prefix = name = template
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO subscans "
+                    "VALUES (?,?,?,?,?,?,?,?,?)",
+                    (name, prefix, seq, _scan_num(prefix), None, n_frames,
+                     state, "", time.time()))
+            return name
+
+    def _on_disk(self, name):
+        return any(os.path.exists(self.path + name + ext)
+                   for ext in [""] + SIDECAR_EXTENSIONS)
+
+    def finish(self, name, state=COMPLETE, start_gps=None):
+        """ Mark a subscan as done and record which sidecar files it
+        ended up with """
+        sidecars = [ext for ext in SIDECAR_EXTENSIONS
+                    if os.path.exists(self.path + name + ext)]
+        if start_gps is None and ".ts" in sidecars:
+            start_gps = tsfile.read_first_timestamp(self.path + name + ".ts")
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE subscans SET state=?, sidecars=?, "
+                "start_gps=COALESCE(?, start_gps) WHERE name=?",
+                (state, ",".join(sidecars), start_gps, name))
+
+    def start(self, name):
+        """ An ARMED subscan has started acquiring """
+        with self.lock, self.db:
+            self.db.execute("UPDATE subscans SET state=?, created=? "
+                            "WHERE name=?", (ACQUIRING, time.time(), name))
+
+    def release(self, name):
+        """ Forget an ARMED subscan that was never started, so its
+        number is handed out again """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM subscans WHERE name=? AND state=?",
+                            (name, ARMED))
+
+    def set_start_gps(self, name, start_gps):
+        with self.lock, self.db:
+            self.db.execute("UPDATE subscans SET start_gps=? WHERE name=?",
+                            (start_gps, name))
+
+    def current(self, max_age=ACQUIRING_TIMEOUT, states=(ACQUIRING,)):
+        """ Name of the subscan currently being acquired, or None
+
+        :param max_age: ignore subscans that started more than this many
+            seconds ago
+        :param states: count subscans in these states, e.g. add ARMED
+            for ones that are about to start
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT name FROM subscans WHERE state IN ({}) AND "
+                "created>? ORDER BY created DESC LIMIT 1".format(
+                    ",".join("?" * len(states))),
+                (*states, time.time() - max_age)).fetchone()
+        return None if row is None else row["name"]
+
+    def get(self, name):
+        """ The catalog row for a subscan as a dict, or None """
+        with self.lock:
+            row = self.db.execute("SELECT * FROM subscans WHERE name=?",
+                                  (name,)).fetchone()
+        return None if row is None else dict(row)
+
+
+def _scan_num(prefix):
+    """ APEX scan number from a prefix like "apecs_12345_" """
+    match = re.search(r"_(\d+)_$", prefix)
+    return int(match.group(1)) if match else None
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """ The ScanCatalog for the data directory, shared by everyone in
+    this process """
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = ScanCatalog()
+        return _catalog
@@ -6,6 +6,8 @@ MOTORS_IP = "10.0.6.165"
 #MOTORS_IP = "10.0.7.215"
 MOTORS_PORT = 4000
 STEPS_PER_CHOP = 560
+# The blade pattern repeats every chop cycle, so indices STEPS_PER_CHOP
+# apart look the same to the beam.
 
 
 class Chopper(motors.Motor):
@@ -16,6 +18,15 @@ class Chopper(motors.Motor):
         self.chop_freq_hz = 0
         self.run_time_s = 0
         self.open=False
+        # Position tracking, so we only home when we have to. After
+        # homing, the controller's step counter (VZ) at the open
+        # position is remembered, and any index congruent to it
+        # modulo STEPS_PER_CHOP is open too.
+        self.tracking = False  # VZ can be trusted to say where we are
+        self.open_index = None  # VZ at the open position
+        self.open_limits = None  # limit bits seen at the open position
+        self.parked = None  # (VZ, limit bits) when the motor was disabled
+        self.homes = 0  # times we had to home
 
     def load_saved_params(self):
         self.setup_chopper(self.chop_freq_hz, self.run_time_s)
@@ -38,6 +49,7 @@ class Chopper(motors.Motor):
 
     def run_chopper(self):
         if self.ready:
+            self._regain_tracking()
             self.open=False
             self.move_steps("+", self.run_steps)
         else:
@@ -51,10 +63,8 @@ class Chopper(motors.Motor):
     def open_chopper(self, disable=True, reload_params=True):
         if not self.open:
             self.set_default_speed()
-            self.go_home(direction="-")
-            self.wait_for_motor()
-            self.move_steps("-", 40)
-            self.wait_for_motor()
+            if not self._go_open_tracked():
+                self._home_and_open()
             if disable:
                 time.sleep(1)
                 self.disable_motor()
@@ -62,6 +72,72 @@ class Chopper(motors.Motor):
                 self.load_saved_params()
             self.open=True
 
+    def disable_motor(self):
+        # A disabled wheel can be nudged, so we stop trusting VZ. If
+        # nothing has changed by the time we need it again, see
+        # _regain_tracking, we carry on from here.
+        parked = None
+        if self.tracking:
+            parked = (self._index(), self.get_limit_binary())
+        super().disable_motor()
+        self.tracking = False
+        self.parked = parked
+
+    def _index(self):
+        try:
+            return int(self.get_current_index())
+        except ValueError:
+            return None
+
+    def _home_and_open(self):
+        self.homes += 1
+        self.go_home(direction="-")
+        self.wait_for_motor()
+        self.move_steps("-", 40)
+        self.wait_for_motor()
+        self.open_index = self._index()
+        self.open_limits = self.get_limit_binary()
+        self.tracking = self.open_index is not None
+
+    def _regain_tracking(self):
+        """ Trust VZ again after the motor was disabled, if neither it
+        nor the limit switches changed in the meantime """
+        if self.tracking:
+            return True
+        if self.parked is None or self.open_index is None:
+            return False
+        index, limits = self.parked
+        self.parked = None
+        self.tracking = (self._index() == index and
+                         self.get_limit_binary() == limits)
+        return self.tracking
+
+    def _go_open_tracked(self):
+        """ Go straight to the open position if we know where we are.
+
+        :return: False if we didn't know, or ended up somewhere that
+            doesn't look like the open position. Home in that case.
+        """
+        try:
+            if not self._regain_tracking():
+                return False
+            self.wait_for_stop()  # a stop() takes a moment
+            # always approach in the same direction as when homing
+            steps = (self._index() - self.open_index) % STEPS_PER_CHOP
+            if steps:
+                self.move_steps("-", steps)
+                self.wait_for_motor()
+            index = self._index()
+            if index is None or \
+               (index - self.open_index) % STEPS_PER_CHOP != 0 or \
+               self.get_limit_binary() != self.open_limits:
+                print("chopper is not where we expected, homing")
+                self.tracking = False
+        except (motors.MotorError, TypeError, ValueError) as e:
+            print(f"lost track of the chopper ({e!r}), homing")
+            self.tracking = False
+        return self.tracking
+
     def close_chopper(self, disable=True, reload_params=True):
         self.open=False
         self.open_chopper(disable=False, reload_params=False)
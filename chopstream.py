@@ -0,0 +1,78 @@
+import numpy as np
+from zeustools import numba_reduction
+
+
+class PhaseAccumulator:
+    def __init__(self, tail):
+        """ Streaming chop-phase reduction for the subscan behind a
+        tailreader.SubscanTail.
+
+        Phase boundaries are kept in a CSR-style offset array: phase k
+        is frames offsets[k]:offsets[k+1], and offsets[n_phases] is the
+        start of the phase that is still being acquired. Each update()
+        only looks at the frames that arrived since the last one, and
+        emit() only reduces chop cycles that completed since the last
+        emit(), so the cost of a poll does not grow with subscan length.
+
+        :param tail: the tailreader.SubscanTail to reduce
+        """
+        self.tail = tail
+        self.offsets = np.zeros(tail.n_frames + 1, dtype=int)
+        self.n_phases = 0  # phases that have ended
+        self.frames_seen = 0
+        self.phases_sent = 0
+        self.finished = False
+
+    def update(self, frames_ready):
+        """ Extend the phase index to cover frames up to frames_ready """
+        if frames_ready <= self.frames_seen:
+            return
+        # start one frame early so we notice a phase change that
+        # happens right at the start of the new frames
+        start = max(self.frames_seen - 1, 0)
+        chop = self.tail.chop[start:frames_ready]
+        starts = np.flatnonzero(np.diff(chop)) + start + 1
+        n = self.n_phases
+        self.offsets[n + 1:n + 1 + len(starts)] = starts
+        self.n_phases += len(starts)
+        self.frames_seen = frames_ready
+
+    def finish(self):
+        """ Close the open phase. Call this once the subscan has ended,
+        since no later frame will come along to end it. """
+        if self.frames_seen > self.offsets[self.n_phases]:
+            self.n_phases += 1
+            self.offsets[self.n_phases] = self.frames_seen
+        self.finished = True
+
+    def emit(self):
+        """ Reduce the chop cycles (pairs of phases) completed since the
+        last call. A lone trailing phase left over by finish() is never
+        emitted.
+
+        :return: None if there is nothing new, otherwise
+            (ts, itime, phase, reduced) with one entry per phase:
+            the mean timestamp, the duration in seconds, the chop phase
+            (1 or 2) and a rows x cols x phases array holding the reduced
+            value (from numba_reduction.offset_data_reduction) of the
+            cycle each phase belongs to.
+        """
+        first = self.phases_sent
+        last = self.n_phases - self.n_phases % 2  # whole cycles only
+        if last <= first:
+            return None
+        bounds = self.offsets[first:last + 1]
+        f0 = bounds[0]
+        f1 = bounds[-1]
+        starts = bounds[:-1] - f0
+        ends = bounds[1:] - f0
+        ts = self.tail.ts[f0:f1]
+        ts_mean = np.add.reduceat(ts, starts) / (ends - starts)
+        itime = ts[ends - 1] - ts[starts]
+        phase = self.tail.chop[bounds[:-1]] + 1
+        reduced = numba_reduction.offset_data_reduction(
+            self.tail.chop[f0:f1],
+            self.tail.cube[:, :, f0:f1]
+        )
+        self.phases_sent = last
+        return ts_mean, itime, phase, np.repeat(reduced, 2, axis=2)
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+try:
+    # watchdog uses inotify on linux
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+DATA_PATH = "/data/cryo/current_data/"
+POLL_INTERVAL = 0.05  # s, only used when watchdog isn't installed
+# File timestamps come from a clock that can lag a jiffy behind, so a
+# change this soon before a token is still treated as after it
+MTIME_SLACK = 20_000_000  # ns
+# Events that mean a file has new contents. Newer watchdogs also report
+# opens and closes without writes, which readers cause themselves.
+CHANGE_EVENTS = ("modified", "created", "moved", "closed")
+
+
+class _ChangeHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in CHANGE_EVENTS:
+            return
+        self.watcher._changed(event.src_path)
+        if hasattr(event, "dest_path"):
+            self.watcher._changed(event.dest_path)
+
+
+class DirectoryWatcher:
+    def __init__(self, path=DATA_PATH):
+        """ Wakes up threads waiting on files in path as soon as the
+        files are written to, so readers don't have to sleep a fixed
+        amount between looking at them.
+
+        Typical use::
+
+            token = watcher.token()
+            ... read whatever is new in the file ...
+            watcher.wait([filename], since=token, timeout=0.5)
+
+        If the watchdog package isn't installed this falls back to
+        checking the size and mtime of the files every POLL_INTERVAL.
+        """
+        self.path = path
+        self.cond = threading.Condition()
+        self.generation = 0  # bumped on every change event
+        self.last_change = {}  # path -> generation of its last change
+        self.observer = None
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(_ChangeHandler(self), path, recursive=False)
+            self.observer.daemon = True
+            self.observer.start()
+        else:
+            print("watchdog is not installed, polling for file changes")
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+    def _changed(self, filename):
+        with self.cond:
+            self.generation += 1
+            self.last_change[os.path.abspath(filename)] = self.generation
+            self.cond.notify_all()
+
+    def token(self):
+        """ Take a token before reading the files. Passing it to wait()
+        makes sure changes made while you were reading aren't missed. """
+        if self.observer is None:
+            return time.time_ns() - MTIME_SLACK
+        with self.cond:
+            return self.generation
+
+    def wait(self, filenames=None, since=None, timeout=None):
+        """ Block until one of filenames changes, or until anything in
+        the directory changes if filenames is None.
+
+        :param since: token from token(). Changes made after it was
+            taken count, even if they happened before wait was called.
+        :param timeout: give up after this many seconds
+        :return: True if there was a change, False on timeout
+        """
+        if self.observer is None:
+            return self._poll(filenames, since, timeout)
+        if since is None:
+            since = self.token()
+        if filenames is not None:
+            filenames = [os.path.abspath(f) for f in filenames]
+
+        def changed():
+            if filenames is None:
+                return self.generation > since
+            return any(self.last_change.get(f, 0) > since for f in filenames)
+
+        with self.cond:
+            return self.cond.wait_for(changed, timeout)
+
+    def _poll(self, filenames, since, timeout):
+        if filenames is None:
+            # stat-ing the whole directory this often would cost more
+            # than it saves.
+            time.sleep(timeout)
+            return False
+        before = [_stat(f) for f in filenames]
+        if since is not None and \
+                any(st is not None and st[1] >= since for st in before):
+            return True  # changed after the token was taken
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            if [_stat(f) for f in filenames] != before:
+                return True
+        return False
+
+
+def _stat(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_watcher(path=DATA_PATH):
+    """ Returns a DirectoryWatcher for path, shared by everyone in
+    this process """
+    with _watchers_lock:
+        if path not in _watchers:
+            _watchers[path] = DirectoryWatcher(path)
+        return _watchers[path]
@@ -6,10 +6,229 @@ import switchbox
 import grating
 import chopper
 from mce_control import mce_control
-from glob import glob
 import subprocess
 import traceback
-import socket
+import select
+import time
+import os
+import itertools
+import catalog
+import shadow
+from concurrent.futures import Future, ThreadPoolExecutor
+
+ABORT_POLL = 0.05  # s; how often _take_data looks at the control channel
+# Every physical device gets a worker thread of its own, so work on one
+# device never waits for another unless a Command says it needs to.
+DEVICES = ("grating", "chopper", "switchbox", "syncbox", "arduino", "mce")
+# Subscans being finalized (waiting for the .ts file, writing the chop
+# and hk files) at the same time as the next one is acquired
+FINALIZE_WORKERS = 2
+DATA_PATH = "/data/cryo/current_data/"
+# s; an armed subscan nobody asked for after this long is released
+ARM_IDLE = 60.0
+# s zframetimes may take to finish once mce_run is done before it is
+# killed. Armed, it waits for its first frame forever.
+FRAMETIMES_TIMEOUT = 10.0
+# s; how long each device may take to configure before we give up on it
+DEVICE_TIMEOUTS = {
+    "arduino": 15,  # 4 commands, each may be retried after a 1 s timeout
+    "chopper": 60,  # opening the chopper means homing it
+    "switchbox": 5,
+    "syncbox": 5,
+    "mce": 10,
+}
+
+
+class AcquisitionAborted(Exception):
+    pass
+
+
+class ConfigureError(Exception):
+    def __init__(self, errors):
+        """ One or more devices failed to configure.
+
+        :param errors: dict of device name -> the exception it raised
+        """
+        self.errors = errors
+        super().__init__("; ".join(f"{name}: {e!r}"
+                                   for name, e in errors.items()))
+
+
+class Command:
+    """ Something for the hardware thread to do. Commands carry their
+    own parameters, so nothing queued behind them can change what they
+    do, and have a concurrent.futures.Future that resolves with the
+    result once the hardware thread is done with them (or with the
+    exception that stopped them). Cancelling the future before the
+    command reaches the front of the queue means it is never run.
+    """
+    device = None  # run on this device's worker instead of the queue's
+    needs = ()  # devices whose earlier work has to finish first
+
+    def __init__(self):
+        self.future = Future()
+
+    def execute(self, zeus):
+        raise NotImplementedError
+
+
+class Configure(Command):
+    def __init__(self, integration_time, sync_time, blank_time,
+                 use_chopper=False):
+        """ :param integration_time: ms mce_run should integrate for
+        :param sync_time: us; time for one chopper phase = 1/2f
+        :param blank_time: us; time for the wobbler to move
+        :param use_chopper: drive the lab chopper instead of the wobbler
+        """
+        super().__init__()
+        self.integration_time = integration_time
+        self.sync_time = sync_time
+        self.blank_time = blank_time
+        self.use_chopper = use_chopper
+
+    def execute(self, zeus):
+        # skychop.py may have changed the devices since the last one
+        shadow.check_external_writes()
+        if not zeus.mce_error and\
+           zeus.configured and \
+           zeus.integration_time == self.integration_time and \
+           zeus.sync_time == self.sync_time and \
+           zeus.blank_time == self.blank_time and \
+           zeus.use_chopper == self.use_chopper and\
+           zeus.do_sync:
+            print("Already configured")
+        else:
+            zeus._disarm()  # armed for the old settings
+            if zeus.mce_error:
+                zeus._reset_mce()
+            zeus.integration_time = self.integration_time
+            zeus.sync_time = self.sync_time
+            zeus.blank_time = self.blank_time
+            zeus.use_chopper = self.use_chopper
+            zeus.do_sync = True
+            zeus.mce_error = False
+            zeus.configured = False
+            zeus._configure_hw_sync()
+            zeus.configured = True
+        if zeus.beams_since_last_configure:
+            # a configure starts a new scan
+            zeus.scan_length = zeus.beams_since_last_configure
+        zeus.beams_since_last_configure = 0
+
+
+class TakeData(Command):
+    # don't start while the grating is still moving, and _take_data
+    # drives the chopper itself
+    needs = ("grating", "chopper")
+
+    def __init__(self, filename):
+        """ :param filename: file to acquire into, optionally with
+            "{num}" in it to be replaced by the next sequence number.
+        The future resolves with the name of the file that was written
+        as soon as the hardware is free for the next subscan.
+        self.started resolves as soon as the acquisition has started,
+        self.finalized once the .ts, chop and hk files are complete.
+        """
+        super().__init__()
+        self.filename = filename
+        self.started = Future()
+        self.finalized = Future()
+        self.seq = None  # numbered by submit(), so aborts can find it
+
+    def execute(self, zeus):
+        try:
+            return zeus._take_data(self)
+        except Exception as e:
+            for future in (self.started, self.finalized):
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, AcquisitionAborted):
+                zeus._acquisition_crashed()
+            raise
+        finally:
+            zeus.taking = None
+
+
+class GratingGo(Command):
+    device = "grating"  # a long move shouldn't hold up a configure
+
+    def __init__(self, idx):
+        super().__init__()
+        self.idx = idx
+
+    def execute(self, zeus):
+        if zeus.grating.idx != self.idx:
+            zeus.grating.grating_go_to_index(self.idx)
+        return zeus.grating.idx
+
+
+class Arm(Command):
+    def __init__(self, filename):
+        """ Get the next subscan ready, so that a TakeData with the same
+        filename only has to start the Arduino.
+
+        :param filename: what the TakeData will be given, usually with
+            "{num}" in it
+        """
+        super().__init__()
+        self.filename = filename
+
+    def execute(self, zeus):
+        return zeus._arm(self.filename)
+
+
+class AutoSetup(Command):
+    def execute(self, zeus):
+        zeus._disarm()
+        if zeus.mce_error:
+            zeus._reset_mce()
+        zeus._auto_setup()
+
+
+class Abort:
+    """ Cut the acquisition in progress short. This is not a Command:
+    it goes through the control channel instead of the queue, so it is
+    seen while _take_data is still waiting on the MCE. The future
+    resolves with the name of the aborted file, or None if nothing was
+    acquiring. TakeData commands still in the queue are aborted before
+    they start.
+    """
+    def __init__(self):
+        self.future = Future()
+
+
+def _print_exception(job):
+    e = job.exception()
+    if e is not None:
+        print(e)
+        traceback.print_tb(e.__traceback__)
+
+
+class Acquisition:
+    def __init__(self, filename, template, n_frames):
+        """ The helper processes of one subscan.
+
+        :param filename: the file being acquired into
+        :param template: the filename TakeData asked for, with {num}
+        :param n_frames: frames mce_run and zframetimes were told to take
+        """
+        self.filename = filename
+        self.template = template
+        self.n_frames = n_frames
+        self.mce_run = None
+        self.zframetimes = None
+
+    def alive(self):
+        return all(proc.poll() is None
+                   for proc in (self.mce_run, self.zframetimes)
+                   if proc is not None)
+
+    def kill(self):
+        for proc in (self.mce_run, self.zframetimes):
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
 
 class ZeusHardwareManager(threading.Thread):
     """ High level interface for all the hardware interfaces for ZEUS-2.
@@ -20,14 +239,19 @@ class ZeusHardwareManager(threading.Thread):
     be needed.
 
     If you decide to break these rules, acquier the hardware_lock while doing so.
+
+    Every public method queues a Command and returns its Future, so
+    callers can wait for the hardware to finish, attach timeouts or
+    cancel work that hasn't started yet. Commands are taken from the
+    queue in order, but grating moves are handed to the grating's own
+    worker (see DEVICES) and don't hold the hardware_lock, so the
+    commands behind them carry on while the grating moves.
      """
     def __init__(self):
         threading.Thread.__init__(self)
         self.hardware_lock = threading.Lock()
         # acquire this lock if you want to talk to the hardware!
         # it's not recommended, but you can do it.
-        self.apecs_callback=None
-        self.apecs_address = None
         # Hardware objects
         self.arduino = None
         self.chopper = None
@@ -38,6 +262,21 @@ class ZeusHardwareManager(threading.Thread):
         self.mce_error = False
         # Control queue
         self.q = Queue()
+        # Priority control channel, read by _take_data while it waits
+        self.control = Queue()
+        # One worker per device, so each device does one thing at a time
+        self.devices = {name: ThreadPoolExecutor(max_workers=1,
+                                                 thread_name_prefix=name)
+                        for name in DEVICES}
+        # Finishes the files of a subscan while the next one is acquired
+        self.finalizer = ThreadPoolExecutor(max_workers=FINALIZE_WORKERS,
+                                            thread_name_prefix="finalize")
+        self.frametimes = None  # the newest zframetimes process
+        self.armed = None  # Acquisition waiting for its TakeData
+        self.armed_at = None  # time.monotonic() when it was armed
+        self.scan_length = None  # subscans in the last scan
+        self.arm_latency = None  # s it took to arm the last time
+        self.start_latency = None  # s from TakeData to the Arduino going
 
         # Acquisition parameters
         self.use_chopper = False
@@ -45,23 +284,36 @@ class ZeusHardwareManager(threading.Thread):
         self.sync_time = 0  # us; time for one chopper phase = 1/2f
         self.blank_time = 0  # us; time for the wobbler to move.
         self.do_sync = True
+        self.configured = False  # the last configure went through
+        self.configure_timing = {}  # device -> s, from the last configure
+        # device -> setup that timed out but may still be writing to it
+        self.stuck = {}
+        # MCE sync registers we have set. Forgotten when the MCE is reset.
+        self.mce_shadow = shadow.ShadowRegisters("mce")
         self.n_frames = 0
-        self.filename = ""
+        self.current_file = None  # file _take_data is acquiring into
+        # TakeData numbering: everything up to abort_through is aborted
+        self.take_seq = itertools.count(1)
+        self.last_take = 0  # seq of the newest TakeData submitted
+        self.abort_through = 0
+        self.taking = None  # seq of the TakeData being executed
         self.reads_per_phase = 0
         self.beams_since_last_configure = 0
-        self.want_grating_index = 0
 
-        self.scan_num = 0
         self.keep_going = True
-        self.send_addr = ("10.0.2.171",33133)
 
+    def submit(self, command):
+        """ Queue a Command for the hardware thread.
+
+        :return: the command's Future
+        """
+        if isinstance(command, TakeData):
+            command.seq = self.last_take = next(self.take_seq)
+        self.q.put(command)
+        return command.future
 
     def configure_grating(self,idx):
-        if self.grating.idx == idx:
-            return
-        else:
-            self.want_grating_index = idx
-            self.q.put("grating")
+        return self.submit(GratingGo(idx))
 
     def configure_sync(
         self, 
@@ -76,33 +328,38 @@ class ZeusHardwareManager(threading.Thread):
 
         todo: provide calculator from chopper params to apecs-like params
         """
-        if not self.mce_error and\
-           self.integration_time == integration_time and \
-           self.sync_time == sync_time and \
-           self.blank_time == blank_time and \
-           self.use_chopper == use_chopper and\
-           self.do_sync:
-            self.apecs_callback(self.apecs_socket,self.apecs_address,"APEX:ZEUS2BE:","configure")
-        else:
-            self.integration_time = integration_time
-            self.sync_time = sync_time
-            self.blank_time = blank_time
-            self.use_chopper = use_chopper
-            self.do_sync = True
-            self.q.put("configure")
-            self.mce_error = False
-        self.beams_since_last_configure=0
+        return self.submit(Configure(integration_time, sync_time,
+                                     blank_time, use_chopper))
 
     def take_data(self, filename):
-        self.filename = filename
-        self.q.put("run")
+        return self.submit(TakeData(filename))
 
     def auto_setup(self):
-        self.q.put("auto_setup")
+        return self.submit(AutoSetup())
+
+    def arm(self, filename):
+        """ Launch mce_run and zframetimes for the next subscan ahead of
+        time. A take_data with the same filename will then start within
+        a few ms. A take_data re-arms with its own filename if the scan
+        is expected to go on. """
+        return self.submit(Arm(filename))
+
+    def abort(self):
+        """ Stop the acquisition in progress as soon as possible: stops
+        the arduino, kills mce_run and zframetimes, stops the chopper
+        and marks the file as aborted in the catalog. Commands still in
+        the queue are not affected, except that TakeData commands that
+        haven't started yet are aborted too. """
+        self.abort_through = self.last_take
+        cmd = Abort()
+        if self.current_file is None:
+            cmd.future.set_result(None)
+        else:
+            self.control.put(cmd)
+        return cmd.future
 
     def run(self):
         print("Setting Up Equipment!")
-        self.apecs_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.arduino = syncuino.Syncuino()
         self.syncbox = syncbox.Syncbox()
         self.mce = mce_control()
@@ -111,82 +368,324 @@ class ZeusHardwareManager(threading.Thread):
         self.switchbox = switchbox.Switchbox()
         print("Done! Listening for APECS commands.")
         while self.keep_going:
+            timeout = 30
+            if self.armed is not None:
+                timeout = max(self.armed_at + ARM_IDLE - time.monotonic(), 0)
             try:
-                cmd = self.q.get(True, 30)
-                with self.hardware_lock:
-                    if cmd == "configure":
-                        self._configure_hw_sync()
-                    elif cmd == "run":
-                        self._take_data()
-                    elif cmd == "grating":
-                        self.grating.grating_go_to_index(self.want_grating_index)
-                    elif cmd == "auto_setup":
-                        self._auto_setup()
+                cmd = self.q.get(True, timeout)
             except Empty:
-                pass
-            except Exception as e:
-                print(e)
-                traceback.print_tb(e.__traceback__)
-                self.chopper.stop() # just in case. It has happened before.
-                # For now this will have to do.
-                # As we collect errors we can 
-                # write methods to handle them.
+                cmd = None
+                if self.armed is not None and \
+                        time.monotonic() - self.armed_at >= ARM_IDLE:
+                    print("no subscan came for the armed file")
+                    with self.hardware_lock:
+                        self._disarm()
+            if cmd is not None and cmd.future.set_running_or_notify_cancel():
+                self._wait_for_devices(cmd.needs)
+                if cmd.device is not None:
+                    self.devices[cmd.device].submit(self._execute, cmd)
+                else:
+                    with self.hardware_lock:
+                        self._execute(cmd)
             if self.mce_error:
+                self.mce_shadow.invalidate()
                 print(self.mce_crash_reset().communicate())
 
-    def _take_data(self):
-        # make sure we don't overwrite anything
+    def _execute(self, cmd):
+        try:
+            cmd.future.set_result(cmd.execute(self))
+        except AcquisitionAborted as e:
+            cmd.future.set_exception(e)
+        except Exception as e:
+            cmd.future.set_exception(e)
+            print(e)
+            traceback.print_tb(e.__traceback__)
+
+    def _acquisition_crashed(self):
+        """ Clean up after _take_data failed. Runs on the hardware
+        thread, like _take_data, so nothing else is acquiring. """
+        if self.current_file is not None:
+            catalog.get_catalog().finish(
+                self.current_file, state=catalog.CRASHED)
+            self.current_file = None
+        self.chopper.stop() # just in case. It has happened before.
+        # For now this will have to do.
+        # As we collect errors we can 
+        # write methods to handle them.
+
+    def _wait_for_devices(self, names):
+        """ Block until everything already handed to these devices'
+        workers is done """
+        barriers = [self.devices[name].submit(lambda: None)
+                    for name in names]
+        for barrier in barriers:
+            barrier.result()
+
+    def _take_data(self, cmd):
+        self._drain_control()  # aborts meant for an earlier file
+        self.taking = cmd.seq
+        self._check_control(0)  # aborted while it was still queued
+        t0 = time.monotonic()
         print("Got GO command! taking data!")
-        f = make_filename(self.filename)
+        acq = self._take_armed(cmd.filename)
+        if acq is None:
+            # make sure we don't overwrite anything
+            f = make_filename(cmd.filename, self.n_frames)
+            acq = Acquisition(f, cmd.filename, self.n_frames)
+        else:
+            catalog.get_catalog().start(acq.filename)
+        f = acq.filename
+        self.current_file = f
         print(f"Acquiring data into file: {f}.")
+        try:
+            if self.use_chopper:
+                self.chopper.run_chopper()
+            if acq.mce_run is None:
+                self._launch(acq)
+            cmd.started.set_result(f)
+            if self.do_sync:
+                self.arduino.go()  # if the arduino starts generating pulses
+                # before the MCE actually starts taking data, the MCE will not
+                # get the correct number of pulses and will hang.
+                print("Arduino is go!")
+            self.start_latency = time.monotonic() - t0
+            print(f"start latency: {self.start_latency*1000:.1f} ms")
+            print("waiting for mce_run to finish acquiring...")
 
-        if self.use_chopper:
-            self.chopper.run_chopper()
+            mce_run = acq.mce_run
+            if self._wait_for_process(mce_run,
+                                      self.integration_time/1000 + 2):
+                output = mce_run.communicate()
+                print(output)  # will probably print nothing
+            # because usually "acq_go" is the last thing it says
+            # But it does print if there are errors
+                if "error" in output[0].decode():
+                    print("MCE error! will need to reset mce!")
+                    self.mce_error = True
+                    acq.kill()  # zframetimes may never see a frame
+            else:
+                self.mce_error = True
+                print("MCE acquire is taking too long! setting error and killing...")
+                acq.kill()
+                print(mce_run.communicate())
+
+            if self.use_chopper:
+                self.chopper.stop()
+                self.devices["chopper"].submit(
+                    self.chopper.open_chopper).add_done_callback(
+                    _print_exception)
+        except AcquisitionAborted:
+            self._abort_acquisition(acq)
+            raise
+        except Exception:
+            acq.kill()
+            raise
+        # The rest doesn't need the hardware, so the next subscan can
+        # start while it runs
+        hk = self._hk_contents()
+        state = catalog.CRASHED if self.mce_error else catalog.COMPLETE
+        self.finalizer.submit(self._finalize, cmd, f, acq.zframetimes,
+                              hk, state)
+        self.current_file = None
+        self.taking = None  # arming the next one isn't part of this one
+        print(f"finished acquiring data file {f}.")
+        self.beams_since_last_configure += 1
+        self._drain_control()
+        if not self.mce_error and self._expect_more():
+            try:
+                self._arm(cmd.filename)
+            except Exception as e:
+                print(f"could not arm the next subscan: {e}")
+        return f
+
+    def _expect_more(self):
+        """ Whether another subscan of this scan is likely to follow.
+        APECS doesn't say how many there are, so assume the scan is as
+        long as the last one. """
+        return self.scan_length is None or \
+            self.beams_since_last_configure < self.scan_length
+
+    def _launch(self, acq, armed=False):
+        """ Start zframetimes and mce_run and wait until mce_run is ready
+        for the first sync pulse. The processes go into acq as soon as
+        they are started, so they can be killed if this fails.
+
+        :param armed: the subscan starts whenever APECS says so, so
+            zframetimes has to wait for its first frame indefinitely
+        """
+        if self.mce_error:
+            # a killed mce_run can leave the MCE half way through an
+            # acquisition, and the next one would hang
+            self._reset_mce()
         if self.do_sync:
             self.syncbox.go()
             # start watching the clock card for time stamps
             # to write into .ts file 
-            zframetimes = self._open_frametimes(f)
-        self.apecs_callback(self.apecs_socket,self.apecs_address,"APEX:ZEUS2BE:","start")
+            acq.zframetimes = self._open_frametimes(acq.filename, armed)
         #start mce_run
-        mce_run = self._mce_run(f)
+        acq.mce_run = mce_run = self._mce_run(acq.filename)
 
         #wait for go signal from mce_run
         text = ""
         while "acq_go" not in text:
+            ready, _, _ = select.select([mce_run.stdout], [], [], 0)
+            if not ready:
+                if mce_run.poll() is not None:
+                    raise RuntimeError(f"mce_run exited before acq_go "
+                                       f"({mce_run.returncode})")
+                self._check_control(ABORT_POLL)
+                continue
             outs = mce_run.stdout.readline()
             text = outs.decode()
             print(text.strip())
-        if self.do_sync:
-            self.arduino.go()  # if the arduino starts generating pulses
-            # before the MCE actually starts taking data, the MCE will not
-            # get the correct number of pulses and will hang.
-            print("Arduino is go!")
-        print("waiting for mce_run to finish acquiring...")
-        
+
+    def _arm(self, template):
+        """ Reserve the next filename for template, launch the helper
+        processes for it and wait until they are ready, so _take_data
+        doesn't have to. """
+        if self.armed is not None and self.armed.template == template \
+                and self.armed.n_frames == self.n_frames \
+                and self.armed.alive():
+            return self.armed.filename  # already armed for it
+        self._disarm()
+        if not self.configured:
+            return None
+        t0 = time.monotonic()
+        f = make_filename(template, self.n_frames, catalog.ARMED)
+        acq = Acquisition(f, template, self.n_frames)
         try:
-            output = mce_run.communicate(timeout=self.integration_time/1000 + 2)
-            print(output)  # will probably print nothing
-        # because usually "acq_go" is the last thing it says
-        # But it does print if there are errors
-            if "error" in output[0].decode():
-                print("MCE error! will need to reset mce!")
-                self.mce_error = True
-        except subprocess.TimeoutExpired:
+            self._launch(acq, armed=True)
+        except BaseException:
+            self._release(acq)
+            raise
+        self.armed = acq
+        self.armed_at = time.monotonic()
+        self.arm_latency = time.monotonic() - t0
+        print(f"armed {f} in {self.arm_latency:.3f} s")
+        return f
+
+    def _take_armed(self, template):
+        """ The armed Acquisition if it is still good for template,
+        otherwise None """
+        acq, self.armed = self.armed, None
+        if acq is None:
+            return None
+        if acq.template == template and acq.n_frames == self.n_frames \
+                and acq.alive():
+            return acq
+        print(f"not using armed file {acq.filename}")
+        self._release(acq)
+        return None
+
+    def _disarm(self):
+        acq, self.armed = self.armed, None
+        if acq is not None:
+            print(f"disarming {acq.filename}")
+            self._release(acq)
+
+    def _release(self, acq):
+        """ Kill the processes of an armed subscan that never started
+        and give its filename back """
+        if acq.mce_run is not None and acq.mce_run.poll() is None:
+            # it may be past acq_go, with the MCE waiting for frames
             self.mce_error = True
-            print("MCE acquire is taking too long! setting error and killing...")
-            mce_run.kill()
-            print(mce_run.communicate())
+        acq.kill()
+        path = DATA_PATH + acq.filename
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # shouldn't happen, but don't throw away data
+            catalog.get_catalog().finish(acq.filename, state=catalog.ABORTED)
+            return
+        for ext in ("", ".run", ".ts", ".tsb"):
+            try:
+                os.remove(path + ext)
+            except FileNotFoundError:
+                pass
+        catalog.get_catalog().release(acq.filename)
 
-        if self.use_chopper:
-            self.chopper.stop()
-            self.chopper.open_chopper()
-        if self.do_sync:
-            zframetimes.wait()
-            self._make_chop_file(f)
-        self._make_hk_file(f)
-        print(f"finished acquiring data file {f}.")
-        self.beams_since_last_configure += 1
+    def _finalize(self, cmd, f, zframetimes, hk, state):
+        """ Wait for the .ts file, then write the chop and hk files and
+        mark the subscan as done in the catalog """
+        try:
+            if zframetimes is not None:
+                try:
+                    zframetimes.wait(FRAMETIMES_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    print(f"zframetimes for {f} is stuck, killing it")
+                    zframetimes.kill()
+                    zframetimes.wait()
+                    state = catalog.CRASHED
+                self._make_chop_file(f)
+            self._make_hk_file(f, hk)
+            catalog.get_catalog().finish(f, state=state)
+            print(f"finalized data file {f}.")
+            cmd.finalized.set_result(f)
+        except Exception as e:
+            print(f"could not finalize {f}: {e}")
+            traceback.print_tb(e.__traceback__)
+            catalog.get_catalog().finish(f, state=catalog.CRASHED)
+            cmd.finalized.set_exception(e)
+
+    def _check_control(self, timeout):
+        """ Wait up to timeout seconds for the control channel. Raises
+        AcquisitionAborted if an Abort arrives, or if one came for this
+        TakeData before it started. """
+        if self.taking is not None and self.taking <= self.abort_through:
+            raise AcquisitionAborted(
+                f"aborted {self.current_file or 'subscan before it started'}")
+        try:
+            cmd = self.control.get(True, timeout)
+        except Empty:
+            return
+        self.control.put(cmd)  # _abort_acquisition answers it
+        raise AcquisitionAborted(f"aborted {self.current_file}")
+
+    def _drain_control(self, result=None):
+        while True:
+            try:
+                self.control.get_nowait().future.set_result(result)
+            except Empty:
+                return
+
+    def _wait_for_process(self, proc, timeout=None):
+        """ Like proc.wait(timeout), but keeps an eye on the control
+        channel.
+
+        :return: True if proc finished, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while proc.poll() is None:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            self._check_control(ABORT_POLL)
+        return True
+
+    def _abort_acquisition(self, acq):
+        """ Stop writing the file and answer the abort first; the
+        devices can take seconds and are dealt with afterwards """
+        f = acq.filename
+        print(f"Aborting acquisition of {f}!")
+        try:
+            acq.kill()
+            if acq.mce_run is not None:
+                # the MCE may still think it is acquiring
+                self.mce_error = True
+            self._make_hk_file(f)
+        finally:
+            catalog.get_catalog().finish(f, state=catalog.ABORTED)
+            self.current_file = None
+            print(f"aborted data file {f}.")
+            self._drain_control(f)
+            if self.use_chopper:
+                def park_chopper():
+                    self.chopper.stop()
+                    self.chopper.open_chopper()
+                self.devices["chopper"].submit(
+                    park_chopper).add_done_callback(_print_exception)
+            if self.do_sync:
+                try:
+                    self.arduino.stop()
+                except Exception as e:
+                    print(f"could not stop the arduino: {e!r}")
 
     def _make_chop_file(self,filename):
         c = subprocess.Popen([
@@ -195,17 +694,25 @@ class ZeusHardwareManager(threading.Thread):
         ])
         c.wait()
 
-    def _make_hk_file(self,filename):
+    def _make_hk_file(self, filename, contents=None):
+        """ :param contents: from _hk_contents(), if the hk file should
+            describe an earlier state of the hardware than the current one
+        """
+        if contents is None:
+            contents = self._hk_contents()
+        with open(f"/data/cryo/current_data/{filename}.hk", 'w') as hkfile:
+            hkfile.write(contents)
+
+    def _hk_contents(self):
         # I apologize from the bottom of my heart 
         # for this implementation.
-        with open(f"/data/cryo/current_data/{filename}.hk", 'w') as hkfile:
-            if self.use_chopper:
-                chop_state="running"
-            elif self.chopper.open:
-                chop_state="open"
-            else:
-                chop_state="closed"
-            hkfile.write(f"""#ZEUS-2 hk
+        if self.use_chopper:
+            chop_state="running"
+        elif self.chopper.open:
+            chop_state="open"
+        else:
+            chop_state="closed"
+        return f"""#ZEUS-2 hk
 MCE_cmd  : see runfile
 acq_mode : None
 int_time     : {self.integration_time}
@@ -240,7 +747,7 @@ itime        : {self.integration_time}
 object     : None
 wavelength : 0.00
 at_pixel   : None
-chop_freq  : 1/(2*sync_time)""")
+chop_freq  : 1/(2*sync_time)"""
 
 
     def _mce_run(self, filename):
@@ -250,7 +757,8 @@ chop_freq  : 1/(2*sync_time)""")
             str(self.n_frames),
             "s",
             f"--timeout={self.sync_time//500}"],
-            stdout = subprocess.PIPE
+            stdout = subprocess.PIPE,
+            bufsize=0  # unbuffered, so select() sees every line
         )
         return mcer
 
@@ -261,29 +769,52 @@ chop_freq  : 1/(2*sync_time)""")
         )
         return mcer
 
+    def _reset_mce(self):
+        """ Reset the MCE after an error and put it back in sync mode """
+        self.mce_shadow.invalidate()
+        print(self.mce_crash_reset().communicate())
+        if self.do_sync and self.configured:
+            self._mce_sync_mode()
+        self.mce_error = False
+
+    def _mce_sync_mode(self):
+        for param, value in (("use_sync", 2), ("use_dv", 2),
+                             ("select_clk", 1)):
+            self.mce_shadow.write(("cc", param), value,
+                                  lambda: self.mce.write("cc", param, value))
+
     def _auto_setup(self):
         a = subprocess.Popen([
             "auto_setup"],
             stdout=subprocess.PIPE
         )
         print(a.communicate()[0].decode())
+        self.mce_shadow.invalidate()  # auto_setup reconfigures the MCE
         if self.do_sync:
-            
-            self.mce.write("cc", "use_sync", 2)
-            self.mce.write("cc", "use_dv", 2)
-            self.mce.write("cc", "select_clk", 1)
+            self._mce_sync_mode()
 
-    def _open_frametimes(self,filename):
+    def _open_frametimes(self, filename, armed=False):
+        if self.frametimes is not None:
+            # the previous subscan's zframetimes may still be reading
+            # the clock card while that subscan is finalized
+            if not self._wait_for_process(self.frametimes,
+                                          FRAMETIMES_TIMEOUT):
+                print("previous zframetimes is stuck, killing it")
+                self.frametimes.kill()
+                self.frametimes.wait()
         print("opening zframetimes...")
-        filename = f"/data/cryo/current_data/{filename}"
+        filename = DATA_PATH + filename
         zf = subprocess.Popen([
             "/usr/bin/zframetimes",
-            "-c",
+            # b: also write the binary .tsb sidecar
+            # w: don't give up before the first frame
+            "-cbw" if armed else "-cb",
             filename,
             str(self.n_frames),
             str(self.reads_per_phase),
             "0"
         ])
+        self.frametimes = zf
         return zf
 
     def _configure_hw_sync(self):
@@ -305,42 +836,101 @@ chop_freq  : 1/(2*sync_time)""")
                arduino period: {arduino_period}
                """)
 
-        self.arduino.set_period(arduino_period)
-        self.arduino.set_frames(reads_per_phase)
-        self.arduino.set_n_blanks(num_phases)
-        self.arduino.set_n_delays(0)  # I don't know what this is...
+        def arduino_setup():
+            self.arduino.set_period(arduino_period)
+            self.arduino.set_frames(reads_per_phase)
+            self.arduino.set_n_blanks(num_phases)
+            self.arduino.set_n_delays(0)  # I don't know what this is...
 
-        if self.use_chopper:
-            self.switchbox.set_labchop()
-            print("switch box set to lab")
-            self.chopper.setup_chopper(read_freq,
-                                       beam_time + 3)
-            print("chopper set up complete")
-        else:
-            self.chopper.open_chopper()
-            self.switchbox.set_apex()
-
-        self.syncbox.use_dv()
-        print("sync box dv on")
-        self.mce.write("cc", "use_sync", 2)
-        self.mce.write("cc", "use_dv", 2)
-        self.mce.write("cc", "select_clk", 1)
-        print("mce in sync mode")
+        def chopper_setup():
+            if self.use_chopper:
+                self.chopper.setup_chopper(read_freq,
+                                           beam_time + 3)
+                print("chopper set up complete")
+            else:
+                self.chopper.open_chopper()
+
+        def switchbox_setup():
+            if self.use_chopper:
+                self.switchbox.set_labchop()
+                print("switch box set to lab")
+            else:
+                self.switchbox.set_apex()
+
+        def syncbox_setup():
+            self.syncbox.use_dv()
+            print("sync box dv on")
+
+        def mce_setup():
+            self._mce_sync_mode()
+            print("mce in sync mode")
+
+        self.configure_timing = self._configure_devices({
+            "arduino": arduino_setup,
+            "chopper": chopper_setup,
+            "switchbox": switchbox_setup,
+            "syncbox": syncbox_setup,
+            "mce": mce_setup,
+        })
         self.n_frames = round(total_reads)
         self.reads_per_phase = round(reads_per_phase)
         print("We Are Configured!")
-        self.apecs_callback(self.apecs_socket,self.apecs_address,"APEX:ZEUS2BE:","configure")
-
-def make_filename(filename):
-    if "{num}" in filename:
-        path = "/data/cryo/current_data/" 
-        files = glob(path + filename.format(num="????"))
-        if len(files) == 0:
-            no = 0
-            print("no files found, starting at 0")
-        else:
-            lastfile = sorted(files)[-1]
-            no = lastfile.replace(path+filename.format(num=""), "")
-            no = int(no)+1
-        filename = filename.format(num="{:04d}".format(no))
-    return filename 
\ No newline at end of file
+
+    def _configure_devices(self, setups):
+        """ Run the setup of each device at the same time, like
+        skychop.do_skychop does, so configuring takes as long as the
+        slowest device rather than all of them added up. Each setup
+        runs on its device's worker, so it waits for anything else that
+        device is busy with.
+
+        :param setups: dict of device name -> function that sets it up
+        :return: dict of device name -> seconds its setup took
+        :raises ConfigureError: naming every device that failed or took
+            longer than its DEVICE_TIMEOUTS entry, or that is still busy
+            with a setup that timed out before
+        """
+        start = time.monotonic()
+        timing = {}
+        errors = {}
+        # a setup that timed out would make its late writes in the
+        # middle of this one, so those devices sit this configure out
+        self.stuck = {name: job for name, job in self.stuck.items()
+                      if not job.done()}
+        for name in self.stuck:
+            if name in setups:
+                errors[name] = RuntimeError(
+                    "still busy with a setup that timed out")
+
+        def timed(name, setup):
+            t0 = time.monotonic()
+            try:
+                setup()
+            finally:
+                timing[name] = time.monotonic() - t0
+
+        jobs = {name: self.devices[name].submit(timed, name, setup)
+                for name, setup in setups.items() if name not in errors}
+        for name, job in jobs.items():
+            timeout = DEVICE_TIMEOUTS[name]
+            try:
+                job.result(timeout=max(start + timeout - time.monotonic(), 0))
+            except Exception as e:
+                if not job.done():
+                    e = TimeoutError(f"no answer after {timeout} s")
+                    if not job.cancel():  # already running
+                        self.stuck[name] = job
+                errors[name] = e
+        print("configure timing: " + ", ".join(
+            f"{name} {t:.2f} s" for name, t in sorted(dict(timing).items())))
+        print("writes sent/skipped: " + ", ".join(
+            f"{name} {sent}/{skipped}"
+            for name, (sent, skipped) in shadow.report().items()))
+        if errors:
+            raise ConfigureError(errors)
+        return timing
+
+
+def make_filename(filename, n_frames=None, state=catalog.ACQUIRING):
+    """ Replaces {num} in filename with the next free sequence number
+    and records the new subscan in the catalog """
+    return catalog.get_catalog().reserve(filename, n_frames, state)
@@ -17,6 +17,14 @@ TAI for any timestamp at or after the given time[1].
   >>> leapseconds.tai_to_utc(datetime(2015, 7, 1, 0, 0, 34))
   datetime.datetime(2015, 6, 30, 23, 59, 59)
 
+The *_array functions do the same for numpy arrays of float seconds
+since 1970-01-01 (in the time scale being converted from) or of
+datetime64:
+
+  >>> import numpy as np
+  >>> leapseconds.utc_to_tai_array(np.array(['2015-07-01'], 'datetime64[ns]'))
+  array(['2015-07-01T00:00:36.000000000'], dtype='datetime64[ns]')
+
 Python 2.6+, Python 3, Jython, Pypy support.
 
 [1]: https://github.com/eggert/tz/blob/master/leap-seconds.list
@@ -26,16 +34,25 @@ Python 2.6+, Python 3, Jython, Pypy support.
 """
 from __future__ import with_statement
 
+import os
+from bisect import bisect_right
 from collections import namedtuple
 from datetime import datetime, timedelta
 from struct import Struct
+from time import monotonic
 from warnings import warn
 
-__all__ = ['leapseconds', 'LeapSecond',
+import numpy as np
+
+__all__ = ['leapseconds', 'LeapSecond', 'leapsecond_table',
            'dTAI_UTC_from_utc', 'dTAI_UTC_from_tai',
            'tai_to_utc', 'utc_to_tai',
            'gps_to_utc', 'utc_to_gps',
-           'tai_to_gps', 'gps_to_tai']
+           'tai_to_gps', 'gps_to_tai',
+           'tai_to_utc_array', 'utc_to_tai_array',
+           'gps_to_utc_array', 'utc_to_gps_array',
+           'tai_to_gps_array', 'gps_to_tai_array',
+           'format_iso']
 
 __version__ = "0.1.0"
 
@@ -74,9 +91,21 @@ dTAI_GPS = timedelta(seconds=19)  # constant offset
 LeapSecond = namedtuple('LeapSecond', 'utc dTAI_UTC')  # tai = utc + dTAI_UTC
 sentinel = LeapSecond(utc=datetime.max, dTAI_UTC=timedelta(0))
 
+# leapseconds() with its transition times as sorted lists, for bisect,
+# and as float seconds since 1970-01-01 (without the sentinel), with
+# the matching dTAI_UTC in seconds, for np.searchsorted
+LeapTable = namedtuple('LeapTable',
+                       'leapseconds utc tai utc_seconds tai_seconds offsets')
+EPOCH = datetime(1970, 1, 1)
+
+TZFILES = ['/usr/share/zoneinfo/right/UTC',
+           '/usr/lib/zoneinfo/right/UTC']
+MTIME_CHECK_INTERVAL = 3600  # s between checks for updated tzdata
+
+_table = None  # (LeapTable, tzfile mtime, monotonic time of last check)
+
 
-def leapseconds(tzfiles=['/usr/share/zoneinfo/right/UTC',
-                         '/usr/lib/zoneinfo/right/UTC'],
+def leapseconds(tzfiles=TZFILES,
                 use_fallback=False):
     """Extract leap seconds from *tzfiles*."""
     for filename in tzfiles:
@@ -171,14 +200,64 @@ def _fallback():
         sentinel]
 
 
+def _tzfile_mtime(tzfiles=TZFILES):
+    for filename in tzfiles:
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            continue
+    return None
+
+
+def leapsecond_table(reload=False):
+    """Cached LeapTable built from leapseconds().
+
+    The tzfile is read once. After that it is only looked at again
+    (its mtime, at most every MTIME_CHECK_INTERVAL seconds) to pick up
+    tzdata updates, or when *reload* is true.
+    """
+    global _table
+    if _table is not None and not reload:
+        table, mtime, checked = _table
+        now = monotonic()
+        if now - checked < MTIME_CHECK_INTERVAL:
+            return table
+        if _tzfile_mtime() == mtime:
+            _table = (table, mtime, now)
+            return table
+    mtime = _tzfile_mtime()
+    leapseconds_list = leapseconds()
+    utc = [ls.utc for ls in leapseconds_list]
+    tai = [ls.utc + ls.dTAI_UTC for ls in leapseconds_list]
+    table = LeapTable(
+        leapseconds_list, utc, tai,
+        np.array([(t - EPOCH).total_seconds() for t in utc[:-1]]),
+        np.array([(t - EPOCH).total_seconds() for t in tai[:-1]]),
+        np.array([ls.dTAI_UTC.total_seconds()
+                  for ls in leapseconds_list[:-1]]))
+    _table = (table, mtime, monotonic())
+    return table
+
+
 def dTAI_UTC_from_utc(utc_time):
     """TAI time = utc_time + dTAI_UTC_from_utc(utc_time)."""
-    return _dTAI_UTC(utc_time, lambda ls: ls.utc)
+    table = leapsecond_table()
+    return _lookup(utc_time, table.utc, table.leapseconds)
 
 
 def dTAI_UTC_from_tai(tai_time):
     """UTC time = tai_time - dTAI_UTC_from_tai(tai_time)."""
-    return _dTAI_UTC(tai_time, lambda ls: ls.utc + ls.dTAI_UTC)
+    table = leapsecond_table()
+    return _lookup(tai_time, table.tai, table.leapseconds)
+
+
+def _lookup(time, transition_times, leapseconds_list):
+    """dTAI_UTC of the interval of sorted *transition_times* that
+    *time* falls in."""
+    if time < transition_times[0]:
+        raise ValueError("Dates before %s are not supported, got %r" % (
+            transition_times[0], time))
+    return leapseconds_list[bisect_right(transition_times, time) - 1].dTAI_UTC
 
 
 def _dTAI_UTC(time, leapsecond_to_time, leapseconds=leapseconds):
@@ -204,14 +283,7 @@ def _dTAI_UTC(time, leapsecond_to_time, leapseconds=leapseconds):
     """
     leapseconds_list = leapseconds()
     transition_times = list(map(leapsecond_to_time, leapseconds_list))
-    if time < transition_times[0]:
-        raise ValueError("Dates before %s are not supported, got %r" % (
-            transition_times[0], time))
-    for i, (start, end) in enumerate(zip(transition_times,
-                                         transition_times[1:])):
-        if start <= time < end:
-            return leapseconds_list[i].dTAI_UTC
-    assert 0
+    return _lookup(time, transition_times, leapseconds_list)
 
 
 def tai_to_utc(tai_time):
@@ -244,6 +316,79 @@ def gps_to_tai(gps_time):
     return gps_time + dTAI_GPS
 
 
+def _dTAI_UTC_array(t, transition_seconds, offsets):
+    """dTAI_UTC for every element of array *t*, in the same kind of
+    units as *t* (float seconds, or timedelta64 for datetime64)."""
+    t = np.asarray(t)
+    is_datetime = np.issubdtype(t.dtype, np.datetime64)
+    if is_datetime:
+        transitions = np.round(transition_seconds * 1e6).astype(
+            'int64').astype('datetime64[us]')
+    else:
+        transitions = transition_seconds
+    if t.size and np.min(t) < transitions[0]:
+        raise ValueError("Dates before %s are not supported" % (
+            transitions[0],))
+    dt = offsets[np.searchsorted(transitions, t, side='right') - 1]
+    if is_datetime:
+        return dt.astype('int64').astype('timedelta64[s]')
+    return dt
+
+
+def tai_to_utc_array(tai):
+    """Convert TAI float seconds or datetime64 array to UTC."""
+    table = leapsecond_table()
+    return tai - _dTAI_UTC_array(tai, table.tai_seconds, table.offsets)
+
+
+def utc_to_tai_array(utc):
+    """Convert UTC float seconds or datetime64 array to TAI."""
+    table = leapsecond_table()
+    return utc + _dTAI_UTC_array(utc, table.utc_seconds, table.offsets)
+
+
+def gps_to_utc_array(gps):
+    """Convert GPS float seconds or datetime64 array to UTC."""
+    return tai_to_utc_array(gps_to_tai_array(gps))
+
+
+def utc_to_gps_array(utc):
+    """Convert UTC float seconds or datetime64 array to GPS."""
+    return tai_to_gps_array(utc_to_tai_array(utc))
+
+
+def _dTAI_GPS_array(t):
+    if np.issubdtype(np.asarray(t).dtype, np.datetime64):
+        return np.timedelta64(dTAI_GPS.seconds, 's')
+    return dTAI_GPS.total_seconds()
+
+
+def tai_to_gps_array(tai):
+    """Convert TAI float seconds or datetime64 array to GPS."""
+    return tai - _dTAI_GPS_array(tai)
+
+
+def gps_to_tai_array(gps):
+    """Convert GPS float seconds or datetime64 array to TAI."""
+    return gps + _dTAI_GPS_array(gps)
+
+
+def format_iso(t, digits=6, suffix=b""):
+    """Format an array of float seconds since 1970-01-01 or datetime64
+    as fixed width ISO 8601 bytes, truncated to *digits* fractional
+    digits and followed by *suffix*.
+
+    >>> format_iso(np.array([1435708800.25]), 4, b"GPS ")
+    array([b'2015-07-01T00:00:00.2500GPS '], dtype='|S28')
+    """
+    t = np.asarray(t)
+    if not np.issubdtype(t.dtype, np.datetime64):
+        t = np.round(t * 1e6).astype('int64').astype('datetime64[us]')
+    iso = np.datetime_as_string(t.astype('datetime64[us]'), unit='us')
+    width = 20 + digits if digits > 0 else 19
+    return np.char.add(iso.astype('S%d' % width), suffix)
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
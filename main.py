@@ -2,8 +2,16 @@ import socket
 import leapseconds
 from datetime import datetime
 import hardware
-import threading
-from queue import Queue, Empty
+import traceback
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+OBSENGINE_ADDRESS = ("10.0.2.171", 33133)
+OBSENGINE_TIMEOUT = 1.0  # s to wait for each reply
+OBSENGINE_RETRIES = 3
+SCAN_NUM_MAX_AGE = 2.0  # s, configures closer together than this share a query
+SCAN_NUM_STALE = 60.0  # s, warn when starting a subscan with an older number
 
 def respond(sock, addr, context, value):
     time_utc = datetime.utcnow()
@@ -13,6 +21,18 @@ def respond(sock, addr, context, value):
     print(f"Sending APECS: {response}")
     sock.sendto(response.encode(), addr)
 
+
+class ApecsProtocol(asyncio.DatagramProtocol):
+    def __init__(self, listener):
+        self.listener = listener
+
+    def connection_made(self, transport):
+        self.listener.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.listener.handle_datagram(data, addr)
+
+
 class ApecsListener():
     #This controls everything
     def __init__(self):
@@ -42,35 +62,68 @@ class ApecsListener():
         self.apecs_address = None
         self.zeus = hardware.ZeusHardwareManager()
         self.obsengine = ObsEngineInterface()
-    
+        # Queries are answered straight from the event loop. Commands
+        # go to this single worker thread, so they still run in the
+        # order they arrived but can never hold up a query.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.loop = None
+        self.transport = None
+
     def go(self):
         self.zeus.start()
-        self.obsengine.start()
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.obsengine.start(self.loop)
         self.obsengine.query_apecs_scan_num()
-        self.zeus.apecs_callback=respond
-        while self.keep_going: 
-            message, address = self.apecs_socket.recvfrom(1024)
-            self.apecs_address = address
-            messages = message.decode().strip().split("\n")
-            for m in messages:
-                self.parse_message(m)
-
-    def parse_message(self, message):
+        await self.loop.create_datagram_endpoint(
+            lambda: ApecsProtocol(self),
+            sock=self.apecs_socket)
+        while self.keep_going:
+            await asyncio.sleep(1)
+        self.transport.close()
+
+    def reply(self, address, context, value):
+        """ Send a response to APECS. Safe to call from any thread. """
+        self.loop.call_soon_threadsafe(
+            respond, self.transport, address, context, value)
+
+    def handle_datagram(self, message, address):
+        """ Handle every line of a datagram as one batch: queries and
+        parameter settings are answered right away, and the commands
+        are handed to the worker together, in order. """
+        self.apecs_address = address
+        commands = []
+        for m in message.decode().strip().split("\n"):
+            command = self.parse_message(m, address)
+            if command is not None:
+                commands.append(command)
+        if commands:
+            # commands see the parameters as they were when they arrived
+            params = dict(self.operating_parameters)
+            job = self.executor.submit(self.execute_batch, commands,
+                                       params, address)
+            job.add_done_callback(_print_exception)
+
+    def parse_message(self, message, address):
+        """ Answers queries and parameter settings. Returns the command
+        to execute if the message is a command, otherwise None. """
         parts = message.strip().split(":")
         print(parts)
         if (parts[0] != "APEX" and parts[0] != "ZSCR") or parts[1] != "ZEUS2BE":
             print(f"ignoring odd message {message}")
-            return
+            return None
         relevant_info = message.replace("APEX:ZEUS2BE:", '').strip()
         if '?' in relevant_info:
             return_val = self.get_parameter(relevant_info)
         elif " " in relevant_info:
             return_val = self.set_parameter(relevant_info)
         else:
-            return_val = self.execute(relevant_info.lower())
-            return # execute does its own response
+            return relevant_info.lower()  # execute does its own response
 
-        respond(self.apecs_socket,self.apecs_address,f"{parts[0]}:{parts[1]}:", return_val)
+        self.reply(address, f"{parts[0]}:{parts[1]}:", return_val)
+        return None
 
     def set_parameter(self, message):
         param, value = message.split(' ')
@@ -88,79 +141,187 @@ class ApecsListener():
             value = "ERROR NOT_IMPLEMENTED"
         return f"{param} {value}"
 
-    def execute(self, command):
+    def execute_batch(self, commands, params, address):
+        for command in commands:
+            self.execute(command, params, address)
+
+    def reply_when_done(self, future, address, response):
+        """ Reply to APECS once the hardware has done what future is
+        waiting for, or with an error if it couldn't. """
+        def done(f):
+            if f.cancelled() or f.exception() is not None:
+                self.reply(address, "APEX:ZEUS2BE:",
+                           response + " ERROR FAILED")
+            else:
+                self.reply(address, "APEX:ZEUS2BE:", response)
+        future.add_done_callback(done)
+
+    def execute(self, command, params, address):
         response = command
-        with self.zeus.hardware_lock:
-            self.zeus.apecs_address = self.apecs_address
         if command == "configure":
-            self.do_configuration()
+            self.reply_when_done(self.do_configuration(params),
+                                 address, response)
             return
         elif command == "gratinggo":
-            self.zeus.configure_grating(int(self.operating_parameters["gratingindex"]))
+            self.zeus.configure_grating(int(params["gratingindex"]))
         elif command == "start":
-            self.run()
+            self.reply_when_done(self.run(params), address, response)
             return
         elif command == "stop":
             self.stop()
         elif command == "abort":
             self.stop()
+            self.reply_when_done(self.zeus.abort(), address, response)
+            return
         elif command == "auto_setup":
             self.zeus.auto_setup()
         else:
             response = response + " ERROR NOT_IMPLEMENTED"
-        respond(self.apecs_socket,self.apecs_address,"APEX:ZEUS2BE:", response)
-
-    def do_configuration(self):
-        op = self.operating_parameters
-        self.zeus.configure_sync(int(op["integrationtime"])*100, 
-                                 int(op["synctime"]), 
-                                 int(op["blanktime"]),
-                                 use_chopper=op["usechopper"]=="1")
-        self.obsengine.query_apecs_scan_num()
+        self.reply(address, "APEX:ZEUS2BE:", response)
+
+    def do_configuration(self, op):
+        job = self.zeus.configure_sync(int(op["integrationtime"])*100,
+                                       int(op["synctime"]),
+                                       int(op["blanktime"]),
+                                       use_chopper=op["usechopper"]=="1")
+        scan = self.obsengine.query_apecs_scan_num(max_age=SCAN_NUM_MAX_AGE)
+        # get the first subscan ready as soon as we know what it's called
+        scan.add_done_callback(
+            lambda _: self.zeus.arm(self.file_template(op)))
+        return job
+
+    def file_template(self, op):
+        scan_num, age = self.obsengine.cached()
+        if age is None or age > SCAN_NUM_STALE:
+            print(f"WARNING: scan number {scan_num} is stale (age {age} s)")
+        if op["usechopper"] == "1":
+            filenum = scan_num + int(op["scan_offset"])
+            return f"skychop_{filenum}_{{num}}"
+        return f"apecs_{scan_num}_{{num}}"
 
-    def run(self):
+    def run(self, op):
+        """ :return: Future that resolves once the acquisition started """
         self.operating_parameters["state"] = "ENABLED"
-        if self.operating_parameters["usechopper"] == "1":
-            filenum = int(self.obsengine.scan_num) + int(self.operating_parameters["scan_offset"])
-            self.zeus.take_data(f"skychop_{filenum}_{{num}}")
-        else:
-            self.zeus.take_data(f"apecs_{self.obsengine.scan_num}_{{num}}")
+        cmd = hardware.TakeData(self.file_template(op))
+        self.zeus.submit(cmd)
+        return cmd.started
 
     def stop(self):
         self.operating_parameters["state"] = "DISABLED"
 
 
-class ObsEngineInterface(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.apecs_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+def _print_exception(job):
+    if job.cancelled():
+        return
+    e = job.exception()
+    if e is not None:
+        print(e)
+        traceback.print_tb(e.__traceback__)
+
+
+class _ObsEngineProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client, request_id):
+        self.client = client
+        self.request_id = request_id
+        self.reply = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if self.request_id != self.client.request_id or self.reply.done():
+            return  # a late reply to a request we gave up on
+        try:
+            # "APEX:OBSENGINE:scanNum 12345 ..."
+            self.reply.set_result(int(data.decode().split(" ")[1]))
+        except (ValueError, IndexError, UnicodeDecodeError):
+            print(f"odd reply from the ObsEngine: {data}")
+
+
+class ObsEngineInterface():
+    def __init__(self, address=OBSENGINE_ADDRESS, timeout=OBSENGINE_TIMEOUT,
+                 retries=OBSENGINE_RETRIES):
+        """ Keeps track of the APEX scan number, which the ObsEngine
+        (Host control3.apex-telescope.org, UDP Port 33133) tells us in
+        reply to the SCPI command "APEX:OBSENGINE:scanNum?".
+
+        Queries run on the listener's event loop and never block the
+        caller. Each attempt gets its own socket and request id, so a
+        reply that turns up after we gave up on it can't be mistaken
+        for the answer to a newer query.
+
+        :param address: (host, port) of the ObsEngine
+        :param timeout: seconds to wait for each reply
+        :param retries: attempts before giving up and keeping the old value
+        """
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
         self.scan_num = 0
-        self.keep_going = True
-        self.q = Queue()
-        self.send_addr = ("10.0.2.171",33133)
+        self.updated = None  # time.monotonic() of the last good reply
+        self.request_id = 0
+        self.pending = None  # the query in flight, if any
+        self.loop = None
 
-    def query_apecs_scan_num(self):
-        self.q.put("get")
+    def start(self, loop):
+        self.loop = loop
 
-    def _query_apecs_scan_num(self):
-        #print("double check obsengine query params")
-        #an number via UDP  from the  ObsEngine   
-        #(Host control3.apex-telescope.org, UDP Port 33133, 
-        #SCPI command "APEX:OBSENGINE:scanNum?”).
-        print("queried scan number")
-        self.apecs_socket.sendto("APEX:OBSENGINE:scanNum?".encode(), self.send_addr)
+    @property
+    def age(self):
+        """ Seconds since scan_num was last confirmed, None if never """
+        if self.updated is None:
+            return None
+        return time.monotonic() - self.updated
 
-    def run(self):
-        while self.keep_going:
+    def cached(self):
+        """ :return: (scan_num, age) without waiting for anything """
+        return self.scan_num, self.age
+
+    def query_apecs_scan_num(self, max_age=None):
+        """ Ask the ObsEngine for the scan number. Safe to call from any
+        thread.
+
+        :param max_age: don't ask if the cached value is younger than this
+        :return: concurrent.futures.Future of the scan number
+        """
+        return asyncio.run_coroutine_threadsafe(self.refresh(max_age),
+                                                self.loop)
+
+    async def refresh(self, max_age=None):
+        age = self.age
+        if max_age is not None and age is not None and age < max_age:
+            return self.scan_num
+        # everyone asking while a query is in flight shares it
+        if self.pending is None or self.pending.done():
+            self.pending = asyncio.ensure_future(self._query())
+        return await asyncio.shield(self.pending)
+
+    async def _query(self):
+        for attempt in range(self.retries):
+            self.request_id += 1
+            try:
+                transport, protocol = \
+                    await self.loop.create_datagram_endpoint(
+                        lambda: _ObsEngineProtocol(self, self.request_id),
+                        remote_addr=self.address)
+            except OSError as e:
+                print(f"can't reach the ObsEngine: {e!r} "
+                      f"(attempt {attempt + 1})")
+                # as long as a lost reply would have taken
+                await asyncio.sleep(self.timeout)
+                continue
             try:
-                cmd = self.q.get(True, 30)
-                if cmd == "get":
-                    self._query_apecs_scan_num()
-                    data,_=self.apecs_socket.recvfrom(1024)
-                    self.scan_num = data.decode().split(" ")[1]
-                    print(data)
-            except Empty:
-                pass
+                print("queried scan number")
+                transport.sendto("APEX:OBSENGINE:scanNum?".encode())
+                self.scan_num = await asyncio.wait_for(protocol.reply,
+                                                       self.timeout)
+                self.updated = time.monotonic()
+                print(f"scan number {self.scan_num}")
+                return self.scan_num
+            except asyncio.TimeoutError:
+                print(f"no reply from the ObsEngine (attempt {attempt + 1})")
+            finally:
+                transport.close()
+        print(f"giving up on the ObsEngine, keeping scan number "
+              f"{self.scan_num} (age {self.age} s)")
+        return self.scan_num
 
 
 if __name__ == "__main__":
@@ -1,12 +1,159 @@
+import re
+import socket
 import time
+import threading
+from collections import deque
+from concurrent.futures import Future
 from vlinx import Vlinx
+import shadow
+
+# Commands the controllers don't answer are spaced write_gap apart.
+# write_gap grows when a query goes unanswered and shrinks again when
+# answers come back promptly.
+WRITE_GAP_MIN = 0.01  # s
+WRITE_GAP_MAX = 0.2  # s; what every command used to cost
+LATENCY_BUDGET = 0.15  # s; queries answered slower than this are reported
+
+# wait_for_motor predicts how long a move of known length takes from the
+# speeds and acceleration last set, sleeps until just before then and
+# polls quickly until the motor stops.
+ACCEL_UNIT = 1000  # steps/s^2 per unit of the "A" setting.
+# Nobody here has a manual that says what "A" means, so this is a guess.
+# Motor.profile_scale corrects the predictions, learned from moves that
+# were polled from the start (the first one of every motor, and one in
+# MEASURE_EVERY after that), so the guess only matters until then.
+MEASURE_EVERY = 20  # moves
+PROFILE_DECAY = 0.9  # scale down by this when we slept through the end
+PROFILE_SCALE_MIN = 0.2
+PROFILE_SCALE_MAX = 5.0
+WAKE_EARLY = 0.1  # s before the predicted end to start polling
+POLL_FAST = 0.02  # s between polls near the end of a predicted move
+POLL_UNKNOWN = 0.1  # s between polls for moves we can't predict
+OVERRUN_FACTOR = 1.5  # a move taking longer than this times the
+OVERRUN_MARGIN = 1.0  # prediction plus this many s is an error
 
 
 class MotorError(Exception):
     pass
 
 
-class Motor(Vlinx):
+class _Request:
+    def __init__(self, motor, commands, query):
+        self.motor = motor
+        self.commands = commands
+        self.query = query
+        self.future = Future()
+
+
+class MotorBus(Vlinx):
+    def __init__(self, address, port):
+        """ The one connection to the vlinx in front of a serial line of
+        motor controllers, shared by every Motor on that line.
+
+        Requests are queued per motor address and a worker thread takes
+        them from the queues in turn, so a motor that is being polled
+        can't starve the others. Only one request is on the line at a
+        time, so the answer to a query always goes back to the Motor
+        that asked, and nobody's flush() throws it away.
+
+        Use get_bus() rather than making these yourself.
+        """
+        super().__init__(address, port)
+        self.write_gap = WRITE_GAP_MIN
+        self.queues = {}  # motor address -> deque of _Requests
+        self.turn = deque()  # motor addresses in the order they get served
+        self.cond = threading.Condition()
+        self.generation = 0  # bumped every time we reconnect
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def request(self, motor, commands, query=None):
+        """ Send commands to a motor in one write and then, optionally,
+        a query. Blocks until it is done.
+
+        :return: (answer, seconds it took to come) for the query,
+            (None, None) if there wasn't one
+        """
+        req = _Request(motor, commands, query)
+        with self.cond:
+            if motor not in self.queues:
+                self.queues[motor] = deque()
+                self.turn.append(motor)
+            self.queues[motor].append(req)
+            self.cond.notify()
+        return req.future.result()
+
+    def _next_request(self):
+        with self.cond:
+            while True:
+                for _ in range(len(self.turn)):
+                    motor = self.turn[0]
+                    self.turn.rotate(-1)
+                    if self.queues[motor]:
+                        return self.queues[motor].popleft()
+                self.cond.wait()
+
+    def _serve(self):
+        while True:
+            req = self._next_request()
+            try:
+                req.future.set_result(self._transact(req))
+            except Exception as e:
+                req.future.set_exception(e)
+                if isinstance(e, OSError):
+                    self._reconnect()
+
+    def _reconnect(self):
+        print(f"reconnecting to the vlinx at {self.address}")
+        try:
+            self.socket.close()
+            self.socket = socket.create_connection((self.address, self.port))
+            self.socket.settimeout(0.1)
+        except OSError as e:
+            print(f"could not reconnect: {e}")
+        self.generation += 1
+
+    def _transact(self, req):
+        if req.commands:
+            self.send("".join(f"@{req.motor}{command}\r"
+                              for command in req.commands))
+            # give the controller time to work through all of them
+            # before anything else is written
+            self.last_write += self.write_gap * (len(req.commands) - 1)
+        if req.query is None:
+            return None, None
+        for attempt in range(2):
+            self.flush()
+            t0 = time.monotonic()
+            self.send(f"@{req.motor}{req.query}\r")
+            response = self.listen()
+            if response:
+                # an answer means the controller has dealt with
+                # everything sent before it, so the next write
+                # doesn't have to wait
+                self.write_gap = max(WRITE_GAP_MIN, self.write_gap / 2)
+                self.last_write = 0
+                return response, time.monotonic() - t0
+            # no answer: the controller may have missed something
+            # we sent too quickly. Slow down and ask again.
+            self.write_gap = min(WRITE_GAP_MAX, self.write_gap * 2)
+        return response, None
+
+
+_buses = {}
+_buses_lock = threading.Lock()
+
+
+def get_bus(address, port):
+    """ Returns the MotorBus for the vlinx at address:port, shared by
+    every Motor in this process """
+    with _buses_lock:
+        if (address, port) not in _buses:
+            _buses[(address, port)] = MotorBus(address, port)
+        return _buses[(address, port)]
+
+
+class Motor:
     def __init__(self, address, port, motor_number):
         """ API for interfacing with ZEUS-2 motorbox 
         ZEUS-2 motorbox uses a vlinx serial-to-tcp server
@@ -27,16 +174,39 @@ class Motor(Vlinx):
         and provides helpful methods for accomplishing that.
         """
         self.motor = motor_number
-        super().__init__(address, port)
+        self.address = address
+        self.port = port
+        self.bus = get_bus(address, port)
+        self.latency = {}  # command -> [count, total s, worst s]
+        # motion profile, as last set. None if we don't know it.
+        self.base_speed = None  # steps/s
+        self.max_speed = None  # steps/s
+        self.acceleration = None  # "A" setting
+        self.move_length = None  # steps in the move just started, if known
+        self.position = None  # index the motor is at or going to, if known
+        self.profile_scale = 1.0  # measured / predicted move time
+        self.calibrated = False  # profile_scale has been measured
+        self.moves_since_measured = 0
+        # settings the controller already has, so they aren't resent
+        self.shadow = shadow.ShadowRegisters(f"motor {motor_number}")
+        self.bus_generation = self.bus.generation
 
     def set_max_speed(self, speed, retries = 2):
-        self.repeat_command_until_success(f"M{speed}", retries=retries)
+        self._set_register("M", speed, retries)
+        self.max_speed = speed
 
     def set_base_speed(self, speed, retries = 2):
-        self.repeat_command_until_success(f"B{speed}", retries=retries)
+        self._set_register("B", speed, retries)
+        self.base_speed = speed
 
     def set_acceleration(self, accel, retries = 2):
-        self.repeat_command_until_success(f"A{accel}", retries=retries)
+        self._set_register("A", accel, retries)
+        self.acceleration = accel
+
+    def _set_register(self, command, value, retries):
+        self.shadow.write(command, value,
+                          lambda: self.repeat_command_until_success(
+                              f"{command}{value}", retries=retries))
 
     def move_steps(self, direction, nsteps):
         """ move nsteps steps in a direction.
@@ -44,33 +214,41 @@ class Motor(Vlinx):
             "-" for CCW.
         :param nsteps: is the number of steps to move 
         """
-        self.send_command(direction)
-        self.send_command(f"N{nsteps}")
-        self.send_command("O0")
-        self.send_command("G")
+        self.send_commands([direction, f"N{nsteps}", "O0", "G"])
+        self.move_length = nsteps
+        self.position = None
 
     def disable_motor(self):
         self.send_command("O1")
 
     def get_current_index(self):
         """ Returns the index the controller thinks it is at """
-        return self.command_response("VZ")
+        index = self.command_response("VZ")
+        try:
+            self.position = int(index)
+        except ValueError:
+            self.position = None
+        return index
 
     def stop(self):
         """ Stops the motor if it is currently moving """
         self.send_command(".")
+        # the move that was going on is over, wherever it got to
+        self.move_length = self.position = None
 
     def start_slew(self,direction="-"):
         """ Sends the commands necessary for moving the motor to its
         home position / limit switch but does not ensure it gets there """
-        self.send_command(direction)  # set direction to negative / clockwise
-        self.send_command("O0")  # make sure motor is enabled
-        self.send_command("S")  # slew to limit switch      
+        self.send_commands([
+            direction,  # set direction to negative / clockwise
+            "O0",  # make sure motor is enabled
+            "S",  # slew to limit switch
+        ])
+        self.move_length = self.position = None
 
     def go_home(self,direction="+"):
-        self.send_command(direction)
-        self.send_command("O0")
-        self.send_command("H0")
+        self.send_commands([direction, "O0", "H0"])
+        self.move_length = self.position = None
 
     def slew_to_hardlimit(self, try_again=True):
         """ Sends the motor to its home position and blocks until it has 
@@ -78,34 +256,119 @@ class Motor(Vlinx):
         self.start_slew()
         self.wait_for_motor()
         self.send_command("Z0")  # set internal step counter to 0
+        self.position = 0
         at_hard_limit = self.check_hard_limit()
         if not at_hard_limit and try_again:
             self.slew_to_hardlimit(try_again=False)
         elif not at_hard_limit:
             raise MotorError("Could not home motor")
 
+    def predict_move_time(self, nsteps):
+        """ Seconds a move of nsteps should take with a trapezoidal
+        speed profile, or None if the profile isn't known. This is
+        before correcting with profile_scale. """
+        if None in (self.base_speed, self.max_speed, self.acceleration):
+            return None
+        vb = self.base_speed
+        vm = max(self.max_speed, vb)
+        a = self.acceleration * ACCEL_UNIT
+        if a <= 0 or vb <= 0:
+            return None
+        ramp_time = (vm - vb) / a
+        ramp_steps = (vb + vm) / 2 * ramp_time
+        if 2 * ramp_steps >= nsteps:
+            # never gets to max speed
+            peak = (vb**2 + a * nsteps) ** 0.5
+            return 2 * (peak - vb) / a
+        return 2 * ramp_time + (nsteps - 2 * ramp_steps) / vm
+
     def wait_for_motor(self):
-        """ Blocks until the motor has stopped moving """
-        moving = True
-        while moving:
-            status = self.command_response("VF")
-            # status = 1 , moving
-            # status = 0 , stopped
-            # status = -1, error
-            try:
-                moving = int(status) > 0
-            except ValueError:
-                pass
-            time.sleep(1)
+        """ Blocks until the motor has stopped moving. If the length of
+        the move is known, sleeps until shortly before it should end
+        and then polls quickly.
+
+        :raises MotorError: if the move runs well over its prediction
+        """
+        t0 = time.monotonic()
+        predicted = None
+        if self.move_length is not None:
+            predicted = self.predict_move_time(self.move_length)
+        self.move_length = None
+        # Sleeping through the end of a move only tells us it took less
+        # than we slept, so every now and then a move is polled all the
+        # way to learn how long moves really take.
+        measure = predicted is not None and \
+            (not self.calibrated or
+             self.moves_since_measured >= MEASURE_EVERY)
+        if predicted is None:
+            interval = POLL_UNKNOWN
+        elif measure:
+            interval = min(POLL_UNKNOWN, max(POLL_FAST, predicted / 20))
+            self.moves_since_measured = 0
+        else:
+            time.sleep(max(predicted * self.profile_scale - WAKE_EARLY, 0))
+            interval = POLL_FAST
+            self.moves_since_measured += 1
+        seen_moving = False
+        while self._moving():
+            seen_moving = True
+            elapsed = time.monotonic() - t0
+            if predicted is not None and self.calibrated and \
+               elapsed > predicted * self.profile_scale * OVERRUN_FACTOR \
+                       + OVERRUN_MARGIN:
+                raise MotorError(
+                    f"motor {self.motor} still moving after {elapsed:.1f} s, "
+                    f"expected {predicted * self.profile_scale:.1f} s")
+            time.sleep(interval)
+        if predicted:
+            self._learn_profile((time.monotonic() - t0) / predicted,
+                                measure or seen_moving)
+
+    def _learn_profile(self, ratio, seen_end):
+        """ Correct profile_scale, so the next wait sleeps for about the
+        right time.
+
+        :param ratio: how long the move took over the prediction
+        :param seen_end: we were polling when the motor stopped, so
+            ratio is a measurement and not just an upper bound
+        """
+        if not seen_end:
+            # we overslept, by how much we can't tell
+            self.profile_scale *= PROFILE_DECAY
+        elif self.calibrated:
+            self.profile_scale = 0.8 * self.profile_scale + 0.2 * ratio
+        else:
+            self.profile_scale = ratio
+            self.calibrated = True
+        self.profile_scale = min(max(self.profile_scale, PROFILE_SCALE_MIN),
+                                 PROFILE_SCALE_MAX)
+
+    def wait_for_stop(self):
+        """ Blocks until the motor has stopped, polling quickly from the
+        start. For after stop(), where there is nothing to predict. """
+        self.move_length = None
+        while self._moving():
+            time.sleep(POLL_FAST)
+
+    def _moving(self):
+        status = self.command_response("VF")
+        # status = 1 , moving
+        # status = 0 , stopped
+        # status = -1, error
+        try:
+            return int(status) > 0
+        except ValueError:
+            return True  # no sense in the answer, ask again
 
     def go_to_index(self, index):
         """ Move to a specific index. 
         Note this does NOT take into account the grating
         quirk that we always want to finish by moving in the same
         direction. """
-        self.send_command(f"P{index}")
-        self.send_command("O0")
-        self.send_command("G")
+        self.send_commands([f"P{index}", "O0", "G"])
+        if self.position is not None:
+            self.move_length = abs(index - self.position)
+        self.position = index
 
     def check_hard_limit(self):
         """ Returns the status of the limit switch.
@@ -141,21 +404,50 @@ class Motor(Vlinx):
 
     def command_response(self,cmd):
         """ Sends a command and listens for a response """
-        self.flush()
-        self.send_command(cmd)
-        return self.listen()
+        return self._request([], cmd)
 
     def send_command(self, command):
         """ Send a command directly to the motor box.
         You need to know what the command is since many
         of them are very arcane """
-        message = f"@{self.motor}{command}\r"
-        self.send(message)
-        time.sleep(0.1)
+        self.send_commands([command])
+
+    def send_commands(self, commands):
+        """ Send several commands to this motor in one write """
+        self._request(commands)
+
+    def _request(self, commands, query=None):
+        if self.bus_generation != self.bus.generation:
+            # we can't be sure what happened while we were cut off
+            self.shadow.invalidate()
+            self.bus_generation = self.bus.generation
+        try:
+            response, seconds = self.bus.request(self.motor, commands, query)
+        except Exception:
+            self.shadow.invalidate()
+            raise
+        if seconds is not None:
+            self._record_latency(query, seconds)
+        return response
+
+    def _record_latency(self, cmd, seconds):
+        name = re.match(r"\D*", cmd).group()
+        stats = self.latency.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        if seconds > LATENCY_BUDGET:
+            print(f"motor {self.motor} took {seconds*1000:.0f} ms to "
+                  f"answer {cmd} (budget {LATENCY_BUDGET*1000:.0f} ms)")
+
+    def latency_report(self):
+        """ :return: {command: (count, mean s, worst s)} of the queries
+            sent to this motor """
+        return {name: (n, total / n, worst)
+                for name, (n, total, worst) in self.latency.items()}
 
     def send_command_check_error(self, command):
-        self.send_command(command)
-        return self.command_response("!")
+        return self._request([command], "!")
 
     def repeat_command_until_success(self, command, retries=2):
         err = self.send_command_check_error(command)
@@ -164,4 +456,5 @@ class Motor(Vlinx):
             self.repeat_command_until_success(command, retries=retries-1)
             print(f"Motor box error: {repr(err)}")
         elif err!="0" and retries == 0:
+            self.shadow.invalidate()
             raise MotorError(f"could not execute command {command}")
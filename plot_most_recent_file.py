@@ -32,7 +32,9 @@ if __name__ == "__main__":
             plt.gcf().canvas.start_event_loop(5)
             continue
         nframes = int(mce.runfile.data["FRAMEACQ"]["DATA_FRAMECOUNT"].strip())
-        if mce.Read(row_col=True).data.shape[2]<nframes-1:
+        # count frames from the file size rather than decoding the
+        # whole file every time we check on it
+        if os.path.getsize(x) // mce.frame_bytes < nframes-1:
             plt.gcf().canvas.draw_idle()
             plt.gcf().canvas.start_event_loop(5)
             continue
@@ -0,0 +1,110 @@
+import os
+import threading
+
+# touched by programs that write device settings behind the server's
+# back, see note_external_write
+EXTERNAL_WRITES_FILE = "/data/cryo/current_data/zeta_device_writes"
+
+_all_shadows = []
+_all_shadows_lock = threading.Lock()
+_external_seen = None  # mtime of EXTERNAL_WRITES_FILE at the last check
+
+
+class ShadowRegisters:
+    def __init__(self, name):
+        """ Last known good values of a device's settings, so writes
+        that wouldn't change anything can be skipped.
+
+        A register is only recorded once its write went through, and
+        it is forgotten when a write fails, so an error always leads
+        to the value being written again next time. Call invalidate()
+        whenever the device may have lost its settings (reconnects,
+        resets, power cycles), and see check_external_writes for
+        other programs.
+
+        :param name: what to call the device in report()
+        """
+        self.name = name
+        self.values = {}
+        self.lock = threading.Lock()
+        self.written = 0
+        self.skipped = 0
+        with _all_shadows_lock:
+            _all_shadows.append(self)
+
+    def write(self, register, value, write):
+        """ Call write() unless register is known to hold value already.
+
+        :return: True if write() was called
+        """
+        with self.lock:
+            if register in self.values and \
+                    self.values[register] == value:
+                self.skipped += 1
+                return False
+            # unknown until the write has gone through
+            self.values.pop(register, None)
+        write()
+        with self.lock:
+            self.values[register] = value
+            self.written += 1
+        return True
+
+    def update(self, register, value):
+        """ Record a value read back from the device """
+        with self.lock:
+            self.values[register] = value
+
+    def get(self, register, default=None):
+        with self.lock:
+            return self.values.get(register, default)
+
+    def invalidate(self, register=None):
+        """ Forget one register, or all of them """
+        with self.lock:
+            if register is None:
+                self.values.clear()
+            else:
+                self.values.pop(register, None)
+
+
+def invalidate_all():
+    """ Forget everything about every device """
+    with _all_shadows_lock:
+        shadows = list(_all_shadows)
+    for s in shadows:
+        s.invalidate()
+
+
+def note_external_write():
+    """ Call this from programs (like skychop.py) that change device
+    settings while the server is running, so the server stops trusting
+    what it thinks the devices hold. """
+    with open(EXTERNAL_WRITES_FILE, 'a'):
+        pass
+    os.utime(EXTERNAL_WRITES_FILE)
+
+
+def check_external_writes():
+    """ invalidate_all() if another program has called
+    note_external_write() since the last check.
+
+    :return: True if the shadows were invalidated
+    """
+    global _external_seen
+    try:
+        stamp = os.stat(EXTERNAL_WRITES_FILE).st_mtime_ns
+    except FileNotFoundError:
+        stamp = None
+    with _all_shadows_lock:
+        changed = stamp != _external_seen
+        _external_seen = stamp
+    if changed:
+        invalidate_all()
+    return changed
+
+
+def report():
+    """ :return: {device name: (writes sent, writes skipped)} """
+    with _all_shadows_lock:
+        return {s.name: (s.written, s.skipped) for s in _all_shadows}
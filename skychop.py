@@ -4,7 +4,8 @@ import switchbox
 import syncuino
 import subprocess
 import threading
-from glob import glob
+import catalog
+import shadow
 from mce_control import mce_control
 #import time
 #this script is going to be a mess
@@ -48,6 +49,7 @@ def mce_setup():
 
 
 def do_skychop():
+    shadow.note_external_write()  # the server has to set them again
     print("set up chopper")
     chop_thread = threading.Thread(target=chopper_setup)
     chop_thread.start()
@@ -68,17 +70,7 @@ def do_skychop():
     mce_thread = threading.Thread(target=mce_setup)
     mce_thread.start()
 
-    filename = "skychop_{num}"
-    path = "/data/cryo/current_data/" 
-    files=glob( path + filename.format(num="????"))
-    if len(files)==0:
-        no=0
-        print("no files found, starting at 0")
-    else:
-        lastfile = sorted(files)[-1]
-        no = lastfile.replace(path+filename.format(num=""),"")
-        no = int(no)+1
-    filename = filename.format(num="{:04d}".format(no))
+    filename = catalog.get_catalog().reserve("skychop_{num}", 1188)
     print(f"filename is {filename}")
     for thread in [
         chop_thread,
@@ -128,6 +120,7 @@ def do_skychop():
         f'/data/cryo/current_data/{filename}'
     ])
     chopfile.wait()
+    catalog.get_catalog().finish(filename)
 
 if __name__ == "__main__":
     do_skychop()
@@ -1,4 +1,5 @@
 from vlinx import Vlinx
+import shadow
 
 SWITCH_BOX_IP = "10.0.6.166"
 SWITCH_BOX_PORT = 4000
@@ -7,16 +8,19 @@ SWITCH_BOX_PORT = 4000
 class Switchbox(Vlinx):
     def __init__(self):
         super().__init__(SWITCH_BOX_IP, SWITCH_BOX_PORT)
+        self.shadow = shadow.ShadowRegisters("switchbox")
         self.state = self.get_state()
 
     def set_apex(self):
         # "B" position
-        self.send("\x02")
+        self.shadow.write("position", "B (APEX)",
+                          lambda: self.send("\x02"))
         self.state = "B (APEX)"
 
     def set_labchop(self):
         # "A" position
-        self.send("\x01")
+        self.shadow.write("position", "A (chop)",
+                          lambda: self.send("\x01"))
         self.state = "A (chop)"
 
     def get_state(self):
@@ -25,10 +29,13 @@ class Switchbox(Vlinx):
         self.send("\x10")
         value = self.listen()
         if 'A' in value:
+            self.shadow.update("position", 'A (chop)')
             return 'A (chop)'
         elif 'B' in value:
+            self.shadow.update("position", 'B (APEX)')
             return 'B (APEX)'
         else:
+            self.shadow.invalidate("position")
             return value
 
 
@@ -1,4 +1,5 @@
 import serial
+import shadow
 
 SYNC_BOX_COM = "/dev/ttyS5"
 
@@ -6,6 +7,7 @@ SYNC_BOX_COM = "/dev/ttyS5"
 class Syncbox:
     def __init__(self):
         self.com = serial.Serial(port=SYNC_BOX_COM, timeout=1)
+        self.shadow = shadow.ShadowRegisters("syncbox")
         self.numrows = 33
         self.rowlen = 50
         self.mode = 'rt'
@@ -17,24 +19,28 @@ class Syncbox:
         self.com.close()
 
     def set_num_rows(self, numrows):
-        self.com.write(f"nr {numrows}\r\n".encode())
+        self.shadow.write("nr", numrows, lambda: self.com.write(
+            f"nr {numrows}\r\n".encode()))
         self.numrows = numrows
 
     def set_row_len(self, rowlen):
-        self.com.write(f"rl {rowlen}\r\n".encode())
+        self.shadow.write("rl", rowlen, lambda: self.com.write(
+            f"rl {rowlen}\r\n".encode()))
         self.rowlen = rowlen
 
     def use_dv(self):
         # In this mode we listen for arduino pulses and use those
         # to syncronize the mce and the clock card
-        self.com.write("rt\r\n".encode())
+        self.shadow.write("mode", "rt", lambda: self.com.write(
+            "rt\r\n".encode()))
         self.mode = 'rt'
 
     def free_run(self, data_rate=1000):
         # In this mode the sync box is constantly commanding the 
         # MCE to take data. I have not quite figured out the 
         # data_rate parameter.
-        self.com.write(f"fr {data_rate}\r\n".encode())
+        self.shadow.write("mode", ("fr", data_rate), lambda: self.com.write(
+            f"fr {data_rate}\r\n".encode()))
         self.mode = 'fr'
         self.data_rate = data_rate
 
@@ -46,6 +52,7 @@ class Syncbox:
 
     def reset(self):
         self.com.write("re\r\n".encode())
+        self.shadow.invalidate()
 
     # def get_hardware_params(self):
     #     old program didn't have this and it wasn't an issue
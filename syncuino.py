@@ -1,25 +1,32 @@
 import serial
+import shadow
 
 ARDUINO_COM = '/dev/ttyACM0'
 
 class Syncuino:
     def __init__(self):
         self.com = serial.Serial(port=ARDUINO_COM, timeout=1)
+        # opening the port resets the arduino, so nothing is known yet
+        self.shadow = shadow.ShadowRegisters("arduino")
 
     def __del__(self):
         self.com.close()
 
     def set_period(self, t_usec):
-        self.send_command(f"P{t_usec}")
+        self._set_register("P", t_usec)
 
     def set_frames(self, nframes):
-        self.send_command(f"N{nframes}")
+        self._set_register("N", nframes)
 
     def set_n_blanks(self, nblanks):
-        self.send_command(f"B{nblanks}")
+        self._set_register("B", nblanks)
 
     def set_n_delays(self, ndelays):
-        self.send_command(f"D{ndelays}")
+        self._set_register("D", ndelays)
+
+    def _set_register(self, command, value):
+        self.shadow.write(command, value,
+                          lambda: self.send_command(f"{command}{value}"))
 
     def go(self):
         """Arduino will start generating pulses at the next 
@@ -42,6 +49,8 @@ class Syncuino:
         elif retries > 0:
             return self.send_command(cmd, retries-1)
         else:
+            # it may have been reset or unplugged
+            self.shadow.invalidate()
             raise IOError("Could not communicate with Arduino")
 
 
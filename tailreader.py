@@ -0,0 +1,299 @@
+import os
+import numpy as np
+from zeustools import mce_data
+import tsfile
+
+MCE_FOOTER_WORDS = 1  # the checksum word at the end of every frame
+MCE_HEADER_VERSION_WORD = 6  # where each frame header says its version
+# words in each frame header, by header version
+MCE_HEADER_WORDS = {6: 43, 7: 43}
+# header version -> (word, bit, inverted) of the chop in the frame
+# header, as learnt from mce_data by MceMemmap._find_chop
+_chop_locations = {}
+
+
+class TimestampTail:
+    def __init__(self, filename):
+        """ Follows a .ts file while zframetimes is still writing it.
+        Each call to read_new only parses the lines that have been
+        appended since the previous call.
+
+        :param filename: path to the .ts file
+        """
+        self.filename = filename
+        self.offset = 0  # bytes of the file consumed so far
+        self.parser = tsfile.TsParser()
+
+    @property
+    def frames_per_phase(self):
+        return self.parser.frames_per_phase
+
+    def read_new(self):
+        """ Returns the timestamps (second column of the .ts file) that
+        have been written since the last call, as a float array """
+        try:
+            with open(self.filename, 'rb') as f:
+                f.seek(self.offset)
+                new = f.read()
+        except FileNotFoundError:
+            return np.zeros(0)
+        self.offset += len(new)
+        _, ts = self.parser.feed(new)
+        return ts
+
+
+class MceMemmap:
+    def __init__(self, filename, mcefile=None):
+        """ Zero-copy access to an MCE flat file through np.memmap.
+        Frames are exposed as strided views into the mapping (header
+        skipped, checksum word excluded), so several readers of the same
+        file share the page cache instead of each holding a copy.
+        Call refresh() to grow the mapping as mce_run writes more frames.
+
+        The header size is what is left of a frame after the data and
+        the checksum, and is checked against the header version of the
+        first frame.
+
+        :param filename: path to the MCE data file (no extension)
+        :param mcefile: an already opened mce_data.SmallMCEFile for this
+            file, if you have one. Used for the frame layout, and for
+            the chop until its place in the header is known.
+        """
+        self.filename = filename
+        if mcefile is None:
+            mcefile = mce_data.SmallMCEFile(filename)
+        self.mcefile = mcefile
+        self.frame_words = mcefile.frame_bytes // 4
+        self.n_rows = mcefile.n_rows
+        self.n_cols = mcefile.n_cols
+        self.header_words = self.frame_words - MCE_FOOTER_WORDS - \
+            self.n_rows * self.n_cols
+        self.header_checked = False
+        self.header_version = None
+        self.words = None
+        self.n_frames = 0
+        self.refresh()
+
+    def refresh(self):
+        """ Re-map the file if it has grown. Returns the number of
+        complete frames in the mapping. """
+        n = os.path.getsize(self.filename) // (self.frame_words * 4)
+        if self.words is None or n != self.n_frames:
+            if n == 0:
+                # np.memmap refuses to map zero bytes
+                self.words = np.zeros((0, self.frame_words), dtype='<i4')
+            else:
+                self.words = np.memmap(self.filename, dtype='<i4', mode='r',
+                                       shape=(n, self.frame_words))
+            self.n_frames = n
+        if n and not self.header_checked:
+            self._check_header()
+        return n
+
+    def _check_header(self):
+        version = int(self.words[0, MCE_HEADER_VERSION_WORD])
+        expected = MCE_HEADER_WORDS.get(version)
+        if expected != self.header_words:
+            raise ValueError(
+                f"{self.filename}: frames have {self.header_words} header "
+                f"words, header version {version} should have {expected}")
+        self.header_version = version
+        self.header_checked = True
+
+    @property
+    def headers(self):
+        """ frames x header words view of the frame headers """
+        return self.words[:, :self.header_words]
+
+    @property
+    def checksums(self):
+        return self.words[:, -MCE_FOOTER_WORDS]
+
+    @property
+    def raw(self):
+        """ rows x cols x frames view of the raw data words """
+        payload = self.words[:, self.header_words:
+                             self.header_words + self.n_rows * self.n_cols]
+        payload = payload.reshape(self.n_frames, self.n_rows, self.n_cols)
+        return payload.transpose(1, 2, 0)
+
+    def channel_offsets(self, pixels):
+        """ Word offset of each MCE (row, col) in pixels within a frame """
+        rows, cols = np.array(pixels, dtype=int).reshape(-1, 2).T
+        return self.header_words + rows * self.n_cols + cols
+
+    def read_channels(self, offsets, start, stop):
+        """ Raw data words of only the channels at offsets (from
+        channel_offsets) for frames start:stop.
+
+        :return: channels x frames array
+        """
+        return self.words[start:stop, offsets].T
+
+    def read_chop(self, start, stop):
+        """ Chop phase of frames start:stop, straight from the chop bit
+        in the mapped frame headers.
+
+        mce_data is what knows where ZEUS-2 keeps the chop, so until the
+        bit has been found (see _find_chop) the frames are decoded
+        through SmallMCEFile.Read as well. That only happens for the
+        first frames with both chop phases in them, once per process.
+        """
+        location = _chop_locations.get(self.header_version)
+        if location is None:
+            self.mcefile.n_frames = max(self.mcefile.n_frames, stop)
+            chop = self.mcefile.Read(start=start, count=stop - start,
+                                     row_col=True).chop
+            location = self._find_chop(start, stop, chop)
+            if location is None:
+                return chop
+        word, bit, inverted = location
+        return ((self.words[start:stop, word] >> bit) & 1) ^ inverted
+
+    def _find_chop(self, start, stop, chop):
+        """ Look for the one header bit that matches chop (from
+        SmallMCEFile.Read) in every frame of start:stop.
+
+        :return: (word, bit, inverted), or None if the frames don't
+            show where the chop is
+        """
+        chop = np.asarray(chop, dtype=int)
+        if chop.min() == chop.max():
+            return None  # both phases are needed to tell bits apart
+        bits = (self.headers[start:stop, :, np.newaxis] >>
+                np.arange(32)) & 1  # frames x words x bits
+        found = [(int(word), int(bit), inverted)
+                 for inverted in (0, 1)
+                 for word, bit in np.argwhere(np.all(
+                     (bits ^ inverted) == chop[:, np.newaxis, np.newaxis],
+                     axis=0))]
+        if len(found) != 1:
+            return None
+        _chop_locations[self.header_version] = found[0]
+        print("chop is bit {1} of header word {0}".format(*found[0]) +
+              (", inverted" if found[0][2] else ""))
+        return found[0]
+
+    def extract(self, raw, field=None):
+        """ Convert raw data words (e.g. a slice of self.raw) into values
+        the same way SmallMCEFile.Read does for this file's data mode """
+        data_mode = mce_data.MCE_data_modes['%i' % self.mcefile.data_mode]
+        if field is None:
+            field = data_mode.fields[0]
+        return data_mode[field].extract(raw)
+
+
+class MceTail:
+    def __init__(self, filename, use_memmap=False, pixels=None):
+        """ Follows an MCE flat file while mce_run is still writing it.
+        Only frames that have been completely written since the last
+        call to read_new are decoded.
+
+        :param filename: path to the MCE data file (no extension)
+        :param use_memmap: decode new frames straight out of an MceMemmap
+            instead of through SmallMCEFile.Read. The chop is read from
+            the frame headers, see MceMemmap.read_chop.
+        :param pixels: list of MCE (row, col). If given, only these
+            channels are decoded and the cube read_new returns is
+            len(pixels) x 1 x frames. Implies use_memmap.
+        """
+        self.filename = filename
+        self.mcefile = mce_data.SmallMCEFile(filename)
+        self.memmap = None
+        self.offsets = None
+        if use_memmap or pixels is not None:
+            self.memmap = MceMemmap(filename, self.mcefile)
+        if pixels is not None:
+            self.offsets = self.memmap.channel_offsets(pixels)
+        self.frames_read = 0
+
+    @property
+    def offset(self):
+        """ Byte offset of the first frame we have not decoded yet """
+        return self.frames_read * self.mcefile.frame_bytes
+
+    def frames_on_disk(self):
+        if self.memmap is not None:
+            return self.memmap.refresh()
+        return os.path.getsize(self.filename) // self.mcefile.frame_bytes
+
+    def read_new(self):
+        """ Decode the frames appended since the last call.
+
+        :return: (cube, chop) where cube is rows x cols x new frames,
+            or (None, None) if no new frames are available.
+        """
+        available = self.frames_on_disk()
+        count = available - self.frames_read
+        if count <= 0:
+            return None, None
+        if self.memmap is not None:
+            start, self.frames_read = self.frames_read, available
+            chop = self.memmap.read_chop(start, available)
+            if self.offsets is not None:
+                raw = self.memmap.read_channels(self.offsets, start,
+                                                available)
+                return self.memmap.extract(raw)[:, np.newaxis, :], chop
+            raw = self.memmap.raw[:, :, start:available]
+            return self.memmap.extract(raw), chop
+        # SmallMCEFile counted the frames when we opened it, but the
+        # file has grown since then.
+        self.mcefile.n_frames = available
+        data = self.mcefile.Read(start=self.frames_read,
+                                 count=count,
+                                 row_col=True)
+        self.frames_read = available
+        return data.data, data.chop
+
+
+class SubscanTail:
+    def __init__(self, data_file, use_memmap=False, pixels=None):
+        """ Keeps the frames and timestamps of the subscan that is
+        currently being acquired. Call poll() periodically; it reads
+        only what has been appended to the data and .ts files since the
+        last poll, so each poll costs O(new frames) instead of
+        O(subscan length).
+
+        :param data_file: path to the MCE data file (no extension)
+        :param use_memmap: read the data file through an MceMemmap.
+        :param pixels: list of MCE (row, col) to keep. If given, cube
+            only holds these channels (as len(pixels) x 1 x frames), so
+            memory and reduction cost scale with the number of pixels
+            rather than the array size. Implies use_memmap.
+        """
+        self.mce = MceTail(data_file, use_memmap=use_memmap, pixels=pixels)
+        self.pixels = pixels
+        self.ts_tail = TimestampTail(data_file + ".ts")
+        runfile = self.mce.mcefile.runfile
+        self.n_frames = int(runfile.data["FRAMEACQ"]["DATA_FRAMECOUNT"].strip())
+        # Buffers are allocated for the whole subscan up front, and
+        # filled in as frames arrive.
+        self.cube = None
+        self.chop = None
+        self.ts = np.zeros(self.n_frames)
+        self.n_data = 0  # frames of MCE data decoded so far
+        self.n_ts = 0  # timestamps parsed so far
+
+    @property
+    def frames_ready(self):
+        """ Number of frames that have both data and a timestamp """
+        return min(self.n_data, self.n_ts)
+
+    def poll(self):
+        """ Read anything new from disk and return frames_ready """
+        ts = self.ts_tail.read_new()
+        n = min(len(ts), self.n_frames - self.n_ts)
+        self.ts[self.n_ts:self.n_ts + n] = ts[:n]
+        self.n_ts += n
+
+        cube, chop = self.mce.read_new()
+        if cube is not None:
+            if self.cube is None:
+                self.cube = np.zeros(cube.shape[:2] + (self.n_frames,),
+                                     dtype=cube.dtype)
+                self.chop = np.zeros(self.n_frames, dtype=chop.dtype)
+            n = min(cube.shape[2], self.n_frames - self.n_data)
+            self.cube[:, :, self.n_data:self.n_data + n] = cube[:, :, :n]
+            self.chop[self.n_data:self.n_data + n] = chop[:n]
+            self.n_data += n
+        return self.frames_ready
@@ -0,0 +1,132 @@
+import os
+import re
+import numpy as np
+
+SIDECAR_SUFFIX = "b"  # foo.ts -> foo.tsb
+SIDECAR_DTYPE = np.dtype('<f8')
+# The sidecar is nothing but one little endian double per frame (GPS
+# seconds since the epoch), as written by zframetimes -b. It has no
+# header so it can be memory-mapped directly.
+
+
+def parse_body(text):
+    """ Parse complete data lines of a .ts file ("index  timestamp").
+
+    :param text: bytes containing only whole data lines
+    :return: (index, ts) float64 arrays
+    """
+    tokens = text.split()
+    if len(tokens) % 2 == 0:
+        try:
+            values = np.array(tokens, dtype=float).reshape(-1, 2)
+            return values[:, 0], values[:, 1]
+        except ValueError:
+            pass
+    # Something odd got into the file (zframetimes complaining about
+    # the clock card, perhaps). Skip the lines we can't understand
+    # like genfromtxt(invalid_raise=False) used to.
+    rows = []
+    for line in text.split(b"\n"):
+        parts = line.split()
+        if len(parts) != 2:
+            continue
+        try:
+            rows.append((float(parts[0]), float(parts[1])))
+        except ValueError:
+            continue
+    values = np.array(rows, dtype=float).reshape(-1, 2)
+    return values[:, 0], values[:, 1]
+
+
+class TsParser:
+    def __init__(self):
+        """ Incremental parser for the .ts files written by zframetimes.
+        Feed it the bytes of the file as they appear and it returns the
+        timestamps from every line that has been completed.
+
+        The file starts with a "# this timestamps file" line and a
+        "## dataframes = N  frames/choppos = M" line. Once the first
+        timestamp arrives, zframetimes finishes the "##" line with
+        "TZOFFSET = Xm   STATBITS = XXXX". All of the "key = value"
+        pairs end up in self.header as strings.
+        """
+        self.header = {}
+        self.partial = b""  # text after the last newline we have seen
+        self.in_body = False  # True once we are past the header
+
+    @property
+    def frames_per_phase(self):
+        if "frames/choppos" in self.header:
+            return int(self.header["frames/choppos"])
+        return None
+
+    def feed(self, new):
+        """ :return: (index, ts) float64 arrays for the new lines """
+        text = self.partial + new
+        end = text.rfind(b"\n") + 1
+        # anything after the last newline is a line zframetimes
+        # hasn't finished writing yet. Keep it for next time.
+        text, self.partial = text[:end], text[end:]
+        while not self.in_body and text:
+            if not text.startswith(b"#"):
+                self.in_body = True
+                break
+            line, _, text = text.partition(b"\n")
+            for key, value in re.findall(rb"(\S+) = (\S+)", line):
+                self.header[key.decode()] = value.decode()
+        return parse_body(text)
+
+
+def read_ts_file(filename):
+    """ Read a whole .ts file.
+
+    :return: (header, ts) where header is a dict of the "key = value"
+        entries in the header lines and ts is a float64 array
+    """
+    parser = TsParser()
+    with open(filename, 'rb') as f:
+        _, ts = parser.feed(f.read() + b"\n")
+    return parser.header, ts
+
+
+def read_first_timestamp(filename):
+    """ Returns the first timestamp in a .ts file without reading
+    the rest of it, or None if there isn't one yet. """
+    parser = TsParser()
+    with open(filename, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                return None  # still being written
+            _, ts = parser.feed(line)
+            if len(ts) > 0:
+                return ts[0]
+    return None
+
+
+def sidecar_name(filename):
+    return filename + SIDECAR_SUFFIX
+
+
+def open_sidecar(filename):
+    """ Memory-map the binary timestamp sidecar of a .ts file.
+
+    :param filename: the .ts file (not the sidecar)
+    :return: float64 array of the timestamps written so far, or None
+        if there is no sidecar. Call again to see newer timestamps.
+    """
+    try:
+        size = os.path.getsize(sidecar_name(filename))
+    except FileNotFoundError:
+        return None
+    n = size // SIDECAR_DTYPE.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=SIDECAR_DTYPE)
+    return np.memmap(sidecar_name(filename), dtype=SIDECAR_DTYPE,
+                     mode='r', shape=(n,))
+
+
+def write_sidecar(filename):
+    """ Write the binary sidecar for an existing .ts file, for data
+    taken before zframetimes learned to write them itself. """
+    _, ts = read_ts_file(filename)
+    ts.astype(SIDECAR_DTYPE).tofile(sidecar_name(filename))
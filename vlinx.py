@@ -2,6 +2,8 @@ import socket
 import time
 
 VERBOSE = True
+WRITE_GAP = 0.1  # s; least time between two writes the device doesn't answer
+
 
 class Vlinx:
     def __init__(self,address,port):
@@ -9,6 +11,12 @@ class Vlinx:
         self.port = port
         self.socket = socket.create_connection((address, port))
         self.socket.settimeout(0.1)
+        # Writes are spaced at least write_gap apart so we don't
+        # overwhelm the vlinx. Subclasses that get answers from their
+        # device can lower it and reset last_write when an answer
+        # shows the device has caught up.
+        self.write_gap = WRITE_GAP
+        self.last_write = 0
 
     def __del__(self):
         self.socket.close()
@@ -17,8 +25,11 @@ class Vlinx:
         # print(f"sending message {message}")
         if VERBOSE:
             print(f"vlinx sending {repr(message)} to {self.address}")
-        self.socket.send(message.encode())
-        time.sleep(0.1)  # ensure that we don't overwhelm the vlinx
+        wait = self.last_write + self.write_gap - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)  # ensure that we don't overwhelm the vlinx
+        self.socket.sendall(message.encode())
+        self.last_write = time.monotonic()
 
     def listen(self):
         """ Listen for any data that may be sent by the vlinx
@@ -34,12 +45,13 @@ class Vlinx:
         return data.strip()
 
     def flush(self):
+        """ Throw away anything the vlinx sent that nobody read, without
+        waiting for more """
         try:
-            self.socket.settimeout(0.1)
-            self.socket.recv(4096)
-        except TimeoutError:
-            pass
-        except socket.timeout:
+            self.socket.setblocking(False)
+            while self.socket.recv(4096):
+                pass
+        except (BlockingIOError, socket.error):
             pass
         finally:
             self.socket.settimeout(3)
@@ -3,7 +3,10 @@
 // see showuse
 // see capt.c for other functionality available
 //
-#define PROG_VERSION "2.1" 
+#define PROG_VERSION "2.4" 
+// v 2.4: flushes the .ts after every batch, for readers following it
+// v 2.3: -w waits as long as it takes for the first timestamp (armed runs)
+// v 2.2: -b also writes datafile.tsb, one little endian double per frame
 // v 2.1: multiple files per mce_run --sequence
 // v 1.8: removing ->n chop index for numpy.loadtxt()
 // v 1.6: removing optional modes, don't need -c, as constant is the only mode
@@ -122,6 +125,7 @@ Other two TTL inputs can be read via PCI-bus.
 
 // input arguments
 char outfilespec[200]; // Output MCE pixel file spec + ".ts", for timestamps
+char binfilespec[204]; // outfilespec + "b", binary timestamps sidecar
 char datafilespec[200]; // program arg
 int  seqindex;
 int NFramestotal;
@@ -131,6 +135,8 @@ PCPS_HR_TIME TShrtimes[682]; // max card list is 680
 MBG_DEV_HANDLE MBGdh;
 
 int constantly; // legacy use, now the only mode
+int binaryout;  // -b: also write the binary sidecar
+int waitfirst;  // -w: no timeout before the first timestamp
 
 char DeviceInfoString[80];
 char DriverInfoString[80];
@@ -241,6 +247,12 @@ char *sprint_hr_cap_time( char *s, const PCPS_HR_TIME *t )
   return s;
 }  // sprint_hr_time
 
+// same value as sprint_hr_cap_time, as a double for the binary sidecar
+double hr_cap_seconds( const PCPS_HR_TIME *t )
+{
+  return (double)t->tstamp.sec + (double)t->tstamp.frac / (double)0xffffffff;
+}
+
 //////////////////////////////////////////////////////////////////////////
 // return count of captures presently in card
 // return -1 error
@@ -306,12 +318,14 @@ void oswarn(int tosec, char *msg)
 
 void showuse(char *cmd)
 {
- printf("use: %s datafile nf nfperblank [nfperfile]\n", cmd);
+ printf("use: %s [-bw] datafile nf nfperblank [nfperfile]\n", cmd);
    puts("   to write datafile.ts timestamp file");
    puts(" datafile    full path to MCE pixel-data file, current acquisition");
    puts(" nf          total number of frames in current acquisition");
    puts(" nfperblank  frames per chop position");
    puts(" [nfperfile  frames per file]");
+   puts(" -b          also write datafile.tsb, one binary double per frame");
+   puts(" -w          wait for the first timestamp without timing out");
  printf("                                                           v %s\n", 
                                                              PROG_VERSION);
 }
@@ -335,6 +349,8 @@ int main( int argc, char* argv[] )
     {
       switch (*ptr++)
       {
+        case 'b' : binaryout = 1; break;
+        case 'w' : waitfirst = 1; break;
         case 'c' : constantly = 1; // legacy support, this is the only mode
         default  : break;
       }
@@ -492,7 +508,9 @@ int getTSconstantly(void)
   int zcount = 0, chophalves = 0;
   int nwrit = 0;
   char buf[128];
+  double totsec;
   FILE *outf;
+  FILE *binf = NULL;
 
   if (!NFramesperfile)
      sprintf(outfilespec, "%s.ts", datafilespec);
@@ -508,6 +526,14 @@ int getTSconstantly(void)
   fprintf(outf, "## dataframes = %d  frames/choppos = %d   ", 
          NFramesperfile ? NFramesperfile : NFramestotal, NFramesperpos);
   // NOTE NO \n IN PREV FPRINTF... for continuation with TZOFFSET below
+  if (binaryout)
+  {  sprintf(binfilespec, "%sb", outfilespec);
+     binf = fopen(binfilespec, "wb");
+     if (NULL == binf)
+     {  printf("Timestamps: can't open %s for writing!\n", binfilespec);
+        return -1;
+     }
+  }
 
   printf("ok\n"); // signal on pipe
   while (nctot < NFramestotal)
@@ -516,6 +542,8 @@ int getTSconstantly(void)
      if (nc < 1)
      {
        usleep(10000); // 10 ms
+       if (waitfirst && 0 == nctot) // armed ahead of the subscan,
+         continue;                  // nobody knows when it starts
        if (++zcount > 400) // 4 sec
        { 
          goto zfwarning;
@@ -552,6 +580,10 @@ int getTSconstantly(void)
         // }
         // else fprintf(outf, "%4d  %s\n", nwrit++, buf);
         fprintf(outf, "%4d  %s\n", nwrit++, buf);
+        if (binf)
+        {  totsec = hr_cap_seconds(&TShrtimes[i]);
+           fwrite(&totsec, sizeof(double), 1, binf);
+        }
         if (NFramesperfile && (!(nctot % NFramesperfile)) && nctot<NFramestotal)
         {
            fclose(outf);
@@ -564,13 +596,25 @@ int getTSconstantly(void)
            fprintf(outf, "# this timestamps file: %s\n", outfilespec);
            fprintf(outf, "## dataframes = %d  frames/choppos = %d\n", 
                                       NFramesperfile , NFramesperpos);
+           if (binf)
+           {  fclose(binf);
+              sprintf(binfilespec, "%sb", outfilespec);
+              binf = fopen(binfilespec, "wb");
+              if (NULL == binf)
+              {  printf("Timestamps: can't open %s for writing!\n",binfilespec);
+                 return -1;
+              }
+           }
         }
      }
+     fflush(outf); // so readers following the file see every batch
+     if (binf) fflush(binf); // so readers can map it right away
   }
 zfwarning:
   // fprintf(outf, "# max ts fifo fill: %d of 680\n", ncmax);
   // fprintf(outf, "#      chop halves: %d\n", chophalves);
   fclose(outf);
+  if (binf) fclose(binf);
 //fprintf(stderr, "*************** ZFRAMETIMES closed %s with %d timestamps\n",
 //                                          TSOutfilespec, nwrit);
   if (nctot < NFramestotal)